@@ -1,6 +1,6 @@
 import os
 import numpy as np
-import tifffile as tiff
+from tiff_memmap import imread_memmap
 from scipy.misc import toimage
 from random import sample
 
@@ -23,7 +23,8 @@ out_path = os.path.join(STACK_dir, out_name)
 initial = True
 for site in selected_sites:
     print 'site: ', site
-    beads = tiff.imread(
+    # STK stacks are memory-mapped rather than decoded into the heap
+    beads = imread_memmap(
         os.path.join(
             STACK_dir,
             well_name,
@@ -1,35 +1,105 @@
 from logging.handlers import RotatingFileHandler
-import multiprocessing, threading, logging, sys, traceback
+import multiprocessing, threading, logging, sys, traceback, os, atexit
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 
 class MultiProcessingLog(logging.Handler):
-    def __init__(self, name, mode, maxsize, rotate):
+    '''Logging handler that funnels records from pool workers to one file.
+
+    Records are sent through a bounded multiprocessing queue to a
+    receiver thread in the process that created the handler, which
+    drains up to `batch_size` records at a time and writes them with a
+    single flush. When the queue is full, overflow='block' applies
+    backpressure to the sending process while overflow='drop' discards
+    the record; dropped records are counted across all processes and
+    reported when the handler is closed. close() stops the receiver and
+    flushes everything that was queued.
+    '''
+
+    def __init__(self, name, mode, maxsize, rotate, queue_size=10000,
+                 overflow='block', batch_size=512):
         logging.Handler.__init__(self)
 
+        if overflow not in ('block', 'drop'):
+            raise ValueError("overflow must be 'block' or 'drop'")
+
         self._handler = RotatingFileHandler(name, mode, maxsize, rotate)
-        self.queue = multiprocessing.Queue(-1)
+        self.queue = multiprocessing.Queue(queue_size)
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.dropped = multiprocessing.Value('L', 0)
+        self._owner_pid = os.getpid()
+        self._closed = False
+
+        self._receiver = threading.Thread(target=self.receive)
+        self._receiver.daemon = True
+        self._receiver.start()
 
-        t = threading.Thread(target=self.receive)
-        t.daemon = True
-        t.start()
+        # multiprocessing closes its queues from its own exit handler, which
+        # runs before logging.shutdown. Handlers registered here run first,
+        # so the queue is drained while it is still open
+        atexit.register(self.close)
 
     def setFormatter(self, fmt):
         logging.Handler.setFormatter(self, fmt)
         self._handler.setFormatter(fmt)
 
     def receive(self):
-        while True:
+        stop = False
+        while not stop:
             try:
-                record = self.queue.get()
-                self._handler.emit(record)
+                records = [self.queue.get()]
+                # drain whatever else is already waiting
+                while len(records) < self.batch_size:
+                    try:
+                        records.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
             except (KeyboardInterrupt, SystemExit):
                 raise
-            except EOFError:
+            except (EOFError, OSError):
+                # the queue has been closed underneath us
                 break
+            if None in records:
+                stop = True
+                records = [r for r in records if r is not None]
+            try:
+                self._write_batch(records)
+            except (KeyboardInterrupt, SystemExit):
+                raise
             except:
+                # e.g. a full disk; keep draining so that senders and
+                # close() never block on a queue that nobody empties
                 traceback.print_exc(file=sys.stderr)
 
+    def _write_batch(self, records):
+        handler = self._handler
+        handler.acquire()
+        try:
+            if handler.stream is None:
+                handler.stream = handler._open()
+            for record in records:
+                if handler.maxBytes > 0 and handler.shouldRollover(record):
+                    handler.stream.flush()
+                    handler.doRollover()
+                handler.stream.write(handler.format(record) + handler.terminator)
+            handler.stream.flush()
+        finally:
+            handler.release()
+
     def send(self, s):
-        self.queue.put_nowait(s)
+        if self.overflow == 'block':
+            self.queue.put(s)
+            return
+        try:
+            self.queue.put_nowait(s)
+        except queue.Full:
+            with self.dropped.get_lock():
+                self.dropped.value += 1
 
     def _format_record(self, record):
         # ensure that exc_info and args
@@ -55,5 +125,17 @@ class MultiProcessingLog(logging.Handler):
             self.handleError(record)
 
     def close(self):
-        self._handler.close()
-        logging.Handler.close(self)
\ No newline at end of file
+        # only the process that owns the receiver thread shuts it down;
+        # forked workers closing their copy must not stop it
+        if os.getpid() == self._owner_pid and not self._closed:
+            self._closed = True
+            if self.dropped.value:
+                self.queue.put(logging.makeLogRecord({
+                    'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'MultiProcessingLog dropped %d records' %
+                           self.dropped.value
+                }))
+            self.queue.put(None)
+            self._receiver.join()
+            self._handler.close()
+        logging.Handler.close(self)
@@ -1,6 +1,8 @@
 import os
 import re
 import csv
+import logging
+import file_operations
 
 # PARAMETERS
 # ----------
@@ -19,6 +21,9 @@ cols = range(7,12)
 sites = range(1,121)
 channels = [4,5,6]
 
+# only print the planned links
+dry_run = False
+
 # CODE
 # ----
 
@@ -28,37 +33,41 @@ wells = [row + str(col).zfill(2) for row in rows for col in cols]
 
 file_list = [fname_stub + well + '_T0001F' + str(site).zfill(3) + 'L01A02Z01C' + str(channel).zfill(2) + '.tif' for well in wells for site in sites for channel in channels]
 
-non_extant = []
-for file in file_list:
-    path = os.path.join(os.path.expanduser(vol_dir), file)
-    if not os.path.isfile(path):
-        non_extant.append(file)
+# one listing of the directory instead of a stat per expected file,
+# audit_plate.py produces the same list for any layout
+existing = set(os.listdir(os.path.expanduser(vol_dir)))
+non_extant = sorted(set(file_list) - existing)
 
 
-# save a list of sites that are missing
+# save a list of sites that are missing, unless nothing is replaced
 out_file_path = os.path.join(os.path.expanduser(base_dir), fname_stub + 'missing_files.csv')
-with open(out_file_path, 'ab') as out_file:
-    wr = csv.writer(out_file, quoting=csv.QUOTE_ALL)
-    wr.writerow(['replaced_image', 'replacement_source'])
-    for file in non_extant:
-        captures = regex.search(file).groupdict()
-        if captures.get('c') == str(4):
-            wr.writerow([file, empty_C04])
-        if captures.get('c') == str(5):
-            wr.writerow([file, empty_C05])
-        if captures.get('c') == str(6):
-            wr.writerow([file, empty_C06])
+if not dry_run:
+    with open(out_file_path, 'a', newline='') as out_file:
+        wr = csv.writer(out_file, quoting=csv.QUOTE_ALL)
+        wr.writerow(['replaced_image', 'replacement_source'])
+        for file in non_extant:
+            captures = regex.search(file).groupdict()
+            if captures.get('c') == str(4):
+                wr.writerow([file, empty_C04])
+            if captures.get('c') == str(5):
+                wr.writerow([file, empty_C05])
+            if captures.get('c') == str(6):
+                wr.writerow([file, empty_C06])
 
 # make hard links to a default empty image for these sites
+empty_images = {'4': empty_C04, '5': empty_C05, '6': empty_C06}
+operations = []
 for file in non_extant:
     path = os.path.join(os.path.expanduser(vol_dir), file)
     # extract well and site
     captures = regex.search(file).groupdict()
-    print 'replacing missing well', captures.get('w'), 'site', captures.get('s'), 'channel', captures.get('c')
-    if captures.get('c') == str(4):
-        os.link(empty_C04, path)
-    elif captures.get('c') == str(5):
-        os.link(empty_C05, path)
-    elif captures.get('c') == str(6):
-        os.link(empty_C06, path)
+    if captures.get('c') in empty_images:
+        print('replacing missing well', captures.get('w'), 'site', captures.get('s'), 'channel', captures.get('c'))
+        operations.append(file_operations.link(empty_images[captures.get('c')], path))
 
+# the links are recorded in a journal next to the images, so that an
+# interrupted run can be resumed and a finished one rolled back with
+# file_operations.rollback_journal
+logging.basicConfig(level=logging.INFO)
+journal_path = os.path.join(vol_dir, fname_stub + 'replace-missing-journal.tsv')
+file_operations.run_plan(operations, journal_path, dry_run=dry_run)
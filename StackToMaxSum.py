@@ -4,6 +4,8 @@ import skimage.io
 import numpy as np
 from os import path, getcwd
 from joblib import Parallel, delayed, cpu_count
+from zprojection import (iter_planes, project_planes, project_stack,
+                         save_plane, save_focus_scores)
 
 warnings.filterwarnings("ignore")
 
@@ -19,7 +21,15 @@ def project_single_site(base_dir, fname_stub, well_name, timeline_name,
                         field, l_name,
                         action_name, input_channel_name,
                         output_channel_names, z_planes,
-                        input_dir, output_dir):
+                        input_dir, output_dir, streaming=True,
+                        statistics=('max', 'sum'), sum_dtype=np.uint16,
+                        focus_metric='laplacian', edf_window=15):
+
+    if len(statistics) != len(output_channel_names):
+        raise ValueError(
+            'got {} projection statistics but {} output channels'.format(
+                len(statistics), len(output_channel_names))
+        )
 
     logger.info('Processing channel %s, well %s, site %d',
                 input_channel_name, well_name, field)
@@ -41,30 +51,39 @@ def project_single_site(base_dir, fname_stub, well_name, timeline_name,
     ]
 
     logger.debug('Well %s, site %d, image paths %s', well_name, field, image_paths)
-    ic = skimage.io.imread_collection(image_paths)
-    arr = skimage.io.concatenate_images(ic)
-    sum_proj = np.sum(arr, axis=0, dtype=np.uint16)
-    max_proj = np.max(arr, axis=0)
-
-    max_name = (
-        fname_stub + well_name + '_' + timeline_name + field_name +
-        l_name + action_name + 'Z01' + output_channel_names[0] + '.tif'
-    )
-    sum_name = (
-        fname_stub + well_name + '_' + timeline_name + field_name +
-        l_name + action_name + 'Z01' + output_channel_names[1] + '.tif'
-    )
-
-    max_path = path.join(base_dir, output_dir, max_name)
-    sum_path = path.join(base_dir, output_dir, sum_name)
-
-    logger.info('Channel %s, well %s, Site %d, saving max projection: %s',
-                input_channel_name, well_name, field, max_path)
-    skimage.io.imsave(fname=max_path, arr=max_proj)
-
-    logger.info('Channel %s, well %s, Site %d, saving sum projection: %s',
-                input_channel_name, well_name, field, sum_path)
-    skimage.io.imsave(fname=sum_path, arr=sum_proj)
+    if streaming:
+        # read each plane once and update all accumulators in one pass
+        projections = project_planes(
+            iter_planes(image_paths), statistics, sum_dtype, focus_metric,
+            edf_window)
+    else:
+        ic = skimage.io.imread_collection(image_paths)
+        arr = skimage.io.concatenate_images(ic)
+        projections = project_stack(arr, statistics, sum_dtype, focus_metric,
+                                    edf_window)
+
+    # each statistic is saved to its own output channel
+    for statistic, output_channel_name in zip(statistics, output_channel_names):
+        out_name = (
+            fname_stub + well_name + '_' + timeline_name + field_name +
+            l_name + action_name + 'Z01' + output_channel_name + '.tif'
+        )
+        out_path = path.join(base_dir, output_dir, out_name)
+
+        logger.info('Channel %s, well %s, Site %d, saving %s projection: %s',
+                    input_channel_name, well_name, field, statistic, out_path)
+        save_plane(out_path, projections[statistic])
+
+    # per-plane focus scores of best_focus/edf projections go to a sidecar
+    if 'focus_scores' in projections:
+        scores_path = path.join(
+            base_dir, output_dir,
+            fname_stub + well_name + '_' + timeline_name + field_name +
+            l_name + action_name + input_channel_name + '_focus.csv'
+        )
+        logger.info('Channel %s, well %s, Site %d, saving focus scores: %s',
+                    input_channel_name, well_name, field, scores_path)
+        save_focus_scores(scores_path, projections['focus_scores'])
 
     return
 
@@ -95,37 +114,23 @@ n_fields = 48
 n_cores = cpu_count() - 1
 
 # Map input channel C03 to C03 (max), C04 (sum)
-#input_channel_name = 'C03'
-#output_channel_names = ['C03', 'C04']
-#
-#for well_name in well_name_list:
-#
-#    # Process sites in parallel
-#    Parallel(n_jobs=n_cores)(
-#        delayed(project_single_site)
-#        (
-#            base_dir, fname_stub,
-#            well_name, timeline_name,
-#            i, l_name, action_name, input_channel_name,
-#            output_channel_names, z_planes,
-#            input_dir, output_dir
-#        ) for i in range(1, n_fields + 1)
-#    )
-
-# Map input channel C04 to C05 (max), C06 (sum)
-input_channel_name = 'C04'
-output_channel_names = ['C05', 'C06']
-
-for well_name in well_name_list:
-
-    # Process sites in parallel
-    Parallel(n_jobs=n_cores)(
-        delayed(project_single_site)
-        (
-            base_dir, fname_stub,
-            well_name, timeline_name,
-            i, l_name, action_name, input_channel_name,
-            output_channel_names, z_planes,
-            input_dir, output_dir
-        ) for i in range(1, n_fields + 1)
-    )
+# and input channel C04 to C05 (max), C06 (sum)
+channel_mappings = [
+#    ('C03', ['C03', 'C04']),
+    ('C04', ['C05', 'C06'])
+]
+
+# Process all wells, sites and channel mappings in a single parallel call
+# so that workers are not restarted and drained once per well
+Parallel(n_jobs=n_cores)(
+    delayed(project_single_site)
+    (
+        base_dir, fname_stub,
+        well_name, timeline_name,
+        i, l_name, action_name, input_channel_name,
+        output_channel_names, z_planes,
+        input_dir, output_dir
+    ) for well_name in well_name_list
+    for i in range(1, n_fields + 1)
+    for input_channel_name, output_channel_names in channel_mappings
+)
@@ -1,11 +1,21 @@
 import warnings
 import logging
 import itertools
+import functools
 import skimage.io
 import numpy as np
 from os import path, getcwd
 import multiprocessing as mp
 from MultiProcessingLog import MultiProcessingLog
+from zprojection import (iter_planes, project_planes, project_stack,
+                         save_plane, save_focus_scores, check_statistics,
+                         FOCUS_STATISTICS, FOCUS_METRICS)
+from projection_pipeline import ProjectionPipeline
+from shared_planes import project_sites_shared_memory
+from tiled_projection import project_tiled
+from projection_manifest import ProjectionManifest, input_signature
+from task_telemetry import (TaskTimer, phase, add_bytes, file_size,
+                            setup_telemetry, report_telemetry)
 
 warnings.filterwarnings('ignore')
 
@@ -17,15 +27,15 @@ logger.addHandler(mp_log)
 logger.setLevel(logging.INFO)
 
 
-def project_single_site(base_dir, fname_stub,
-                        well_name, timeline_name,
-                        field, l_name,
-                        action_name, input_channel_name,
-                        output_channel_names, z_planes,
-                        input_dir, output_dir):
+def site_paths(base_dir, fname_stub,
+               well_name, timeline_name,
+               field, l_name,
+               action_name, input_channel_name,
+               output_channel_names, z_planes,
+               input_dir, output_dir):
 
-    logger.info('Processing channel %s, well %s, site %d',
-                input_channel_name, well_name, field)
+    # paths of the input z-planes and of one output image per
+    # output channel for a single site
     field_name = 'F' + str(field).zfill(3)
 
     image_names = []
@@ -43,39 +53,194 @@ def project_single_site(base_dir, fname_stub,
         path.join(base_dir, input_dir, in_name) for in_name in image_names
     ]
 
-    logger.debug('Well %s, site %d, image paths %s', well_name, field, image_paths)
-    ic = skimage.io.imread_collection(image_paths)
-    arr = skimage.io.concatenate_images(ic)
-    sum_proj = np.sum(arr, axis=0, dtype=np.uint16)
-    max_proj = np.max(arr, axis=0)
+    output_paths = []
+    for output_channel_name in output_channel_names:
+        out_name = (
+            fname_stub + well_name + '_' + timeline_name + field_name +
+            l_name + action_name + 'Z01' + output_channel_name + '.tif'
+        )
+        output_paths.append(path.join(base_dir, output_dir, out_name))
 
-    max_name = (
-        fname_stub + well_name + '_' + timeline_name + field_name +
-        l_name + action_name + 'Z01' + output_channel_names[0] + '.tif'
-    )
-    sum_name = (
+    return image_paths, output_paths
+
+
+def focus_scores_path(base_dir, fname_stub,
+                      well_name, timeline_name,
+                      field, l_name,
+                      action_name, input_channel_name,
+                      output_channel_names, z_planes,
+                      input_dir, output_dir):
+
+    # sidecar with the per-plane focus scores of a site
+    field_name = 'F' + str(field).zfill(3)
+    return path.join(
+        base_dir, output_dir,
         fname_stub + well_name + '_' + timeline_name + field_name +
-        l_name + action_name + 'Z01' + output_channel_names[1] + '.tif'
+        l_name + action_name + input_channel_name + '_focus.csv'
     )
 
-    max_path = path.join(base_dir, output_dir, max_name)
-    sum_path = path.join(base_dir, output_dir, sum_name)
 
-    logger.info('Channel %s, well %s, Site %d, saving max projection: %s',
-                input_channel_name, well_name, field, max_path)
-    skimage.io.imsave(fname=max_path, arr=max_proj)
+def project_single_site(base_dir, fname_stub,
+                        well_name, timeline_name,
+                        field, l_name,
+                        action_name, input_channel_name,
+                        output_channel_names, z_planes,
+                        input_dir, output_dir, streaming=True,
+                        statistics=('max', 'sum'), sum_dtype=np.uint16,
+                        focus_metric='laplacian', edf_window=15,
+                        memory_budget=None):
+
+    if len(statistics) != len(output_channel_names):
+        raise ValueError(
+            'got {} projection statistics but {} output channels'.format(
+                len(statistics), len(output_channel_names))
+        )
+
+    logger.info('Processing channel %s, well %s, site %d',
+                input_channel_name, well_name, field)
+
+    image_paths, output_paths = site_paths(
+        base_dir, fname_stub, well_name, timeline_name, field, l_name,
+        action_name, input_channel_name, output_channel_names, z_planes,
+        input_dir, output_dir)
+
+    logger.debug('Well %s, site %d, image paths %s', well_name, field, image_paths)
+    if memory_budget is not None:
+        # reduce tile by tile and write straight into the outputs
+        logger.info('Channel %s, well %s, Site %d, tiled projection to %s',
+                    input_channel_name, well_name, field,
+                    ', '.join(output_paths))
+        with phase('compute'):
+            project_tiled(image_paths, list(zip(statistics, output_paths)),
+                          statistics, sum_dtype, memory_budget)
+        add_bytes(read=sum(file_size(p) for p in image_paths),
+                  written=sum(file_size(p) for p in output_paths))
+        return
+
+    if streaming:
+        # read each plane once and update all accumulators in one pass
+        with phase('compute'):
+            projections = project_planes(
+                timed_planes(iter_planes(image_paths)),
+                statistics, sum_dtype, focus_metric, edf_window)
+    else:
+        with phase('read'):
+            ic = skimage.io.imread_collection(image_paths)
+            arr = skimage.io.concatenate_images(ic)
+        add_bytes(read=arr.nbytes)
+        with phase('compute'):
+            projections = project_stack(
+                arr, statistics, sum_dtype, focus_metric, edf_window)
+
+    # each statistic is saved to its own output channel
+    with phase('write'):
+        for statistic, out_path in zip(statistics, output_paths):
+            logger.info('Channel %s, well %s, Site %d, saving %s projection: %s',
+                        input_channel_name, well_name, field, statistic,
+                        out_path)
+            save_plane(out_path, projections[statistic])
+            add_bytes(written=file_size(out_path))
 
-    logger.info('Channel %s, well %s, Site %d, saving sum projection: %s',
-                input_channel_name, well_name, field, sum_path)
-    skimage.io.imsave(fname=sum_path, arr=sum_proj)
+        # per-plane focus scores of best_focus/edf projections go to a
+        # sidecar
+        if 'focus_scores' in projections:
+            scores_path = focus_scores_path(
+                base_dir, fname_stub, well_name, timeline_name, field, l_name,
+                action_name, input_channel_name, output_channel_names,
+                z_planes, input_dir, output_dir)
+            logger.info('Channel %s, well %s, Site %d, saving focus scores: %s',
+                        input_channel_name, well_name, field, scores_path)
+            save_focus_scores(scores_path, projections['focus_scores'])
 
     return
 
 
+def timed_planes(planes):
+    # count the time spent fetching each plane as read time, leaving the
+    # reduction to the enclosing compute phase. Memory-mapped planes are
+    # only paged in when they are reduced, so for uncompressed inputs
+    # part of the I/O shows up as compute time
+    planes = iter(planes)
+    while True:
+        with phase('read'):
+            plane = next(planes, None)
+        if plane is None:
+            return
+        add_bytes(read=plane.nbytes)
+        yield plane
+
+
+def site_key(task):
+    # identifies a (well, site, input channel) in the manifest and logs
+    well_name, field, input_channel_name = task[2], task[4], task[7]
+    return '{}_F{}_{}'.format(well_name, str(field).zfill(3), input_channel_name)
+
+
+def sites_from_tasks(tasks, statistics=('max', 'sum')):
+    # (key, image_paths, output_paths) descriptions of each site, as
+    # consumed by the pipelined and shared memory projection modes,
+    # including the focus score sidecar for best_focus and edf
+    sites = []
+    for task in tasks:
+        image_paths, output_paths = site_paths(*task)
+        output_paths = list(zip(statistics, output_paths))
+        if any(s in FOCUS_STATISTICS for s in statistics):
+            output_paths.append(('focus_scores', focus_scores_path(*task)))
+        sites.append((site_key(task), image_paths, output_paths))
+    return sites
+
+
+def manifest_outputs(task, statistics=('max', 'sum')):
+    # every file a completed site has written, including the focus score
+    # sidecar of best_focus and edf, so that a missing one is redone
+    image_paths, output_paths = site_paths(*task)
+    if any(s in FOCUS_STATISTICS for s in statistics):
+        output_paths.append(focus_scores_path(*task))
+    return image_paths, output_paths
+
+
+def project_sites_pipelined(tasks, statistics=('max', 'sum'),
+                            sum_dtype=np.uint16, n_readers=4,
+                            prefetch_sites=2, write_queue_depth=4,
+                            focus_metric='laplacian', edf_window=15):
+
+    # project a batch of sites, overlapping the reads of the next sites
+    # and the writes of the previous ones with the current reduction
+    pipeline = ProjectionPipeline(
+        statistics, sum_dtype, n_readers=n_readers,
+        prefetch_sites=prefetch_sites, write_queue_depth=write_queue_depth,
+        focus_metric=focus_metric, edf_window=edf_window)
+    return pipeline.run(sites_from_tasks(tasks, statistics))
+
+
 def project_single_site_star(args):
     return project_single_site(*args)
 
 
+def project_single_site_checked(task, statistics=('max', 'sum'),
+                                focus_metric='laplacian', edf_window=15,
+                                memory_budget=None):
+    # report failures back to the parent instead of aborting the pool,
+    # so that the remaining sites still complete and get recorded
+    with TaskTimer('project_site', site_key(task)) as timer:
+        try:
+            project_single_site(*task, statistics=statistics,
+                                focus_metric=focus_metric,
+                                edf_window=edf_window,
+                                memory_budget=memory_budget)
+        except Exception as err:
+            logger.error('%s, projection failed: %s', site_key(task), err)
+            timer.error = str(err)
+    return site_key(task), timer.error
+
+
+def projection_chunksize(n_tasks, n_workers, chunks_per_worker=8):
+    # each site takes seconds to project, so hand out small chunks to
+    # keep the tail of the run balanced while still amortising the IPC
+    # overhead of imap_unordered on very large plates
+    return max(1, n_tasks // (n_workers * chunks_per_worker))
+
+
 def main():
 
     # Define parameters
@@ -103,43 +268,130 @@ def main():
     n_fields = 48
 
     # Map input channel C03 to C03 (max), C04 (sum)
-    input_channel_name = 'C03'
-    output_channel_names = ['C03', 'C04']
+    # and input channel C04 to C05 (max), C06 (sum)
+    channel_mappings = [
+        ('C03', ['C03', 'C04']),
+        ('C04', ['C05', 'C06'])
+    ]
 
-    # create a multiprocessing pool for parallelisation
-    pool = mp.Pool()
+    # schedule every (well, site, channel mapping) of the plate in a
+    # single pool so that workers stay busy across channel and well
+    # boundaries instead of draining at the end of each batch
     fields = range(1, n_fields + 1)
-    pool.map(
-        project_single_site_star,
-        [(base_dir, fname_stub,
+    tasks = [
+        (base_dir, fname_stub,
             well, timeline_name,
             site, l_name,
             action_name, input_channel_name,
             output_channel_names, z_planes,
-            input_dir, output_dir) for well, site in itertools.product(well_name_list, fields)]
-    )
-    pool.close()
-    pool.join()
+            input_dir, output_dir)
+        for well, site, (input_channel_name, output_channel_names)
+        in itertools.product(well_name_list, fields, channel_mappings)
+    ]
 
-    # Map input channel C04 to C05 (max), C06 (sum)
-    input_channel_name = 'C04'
-    output_channel_names = ['C05', 'C06']
+    # 'pool': one site per task in a process pool
+    # 'pipelined': each worker prefetches the planes of its next sites
+    #   with a few reader threads and writes from a background thread
+    # 'shared_memory': separate reader and reducer processes exchange
+    #   planes through shared memory slots and can be scaled independently
+    mode = 'pool'
+    sites_per_batch = 16
+    n_readers = 8
+    # any of max, sum, mean, min, std, argmax_z, best_focus and edf,
+    # paired with the output channel names of each channel mapping
+    statistics = ('max', 'sum')
+    # plane sharpness measure of best_focus and edf, laplacian or
+    # tenengrad, and the neighbourhood in pixels that edf compares
+    focus_metric = 'laplacian'
+    edf_window = 15
+    # bytes of working memory per site in 'pool' mode; when set, stacks
+    # are projected tile by tile, e.g. for large fields or long stacks
+    memory_budget = None
 
-    # create a multiprocessing pool for parallelisation
-    pool = mp.Pool()
-    fields = range(1, n_fields + 1)
-    pool.map(
-        project_single_site_star,
-        [(base_dir, fname_stub,
-            well, timeline_name,
-            site, l_name,
-            action_name, input_channel_name,
-            output_channel_names, z_planes,
-            input_dir, output_dir) for well, site in itertools.product(well_name_list, fields)]
-    )
-    pool.close()
-    pool.join()
+    # settings that would fail every site are rejected before scheduling
+    check_statistics(statistics)
+    if focus_metric not in FOCUS_METRICS:
+        raise ValueError('unknown focus metric {}, choose from {}'.format(
+            focus_metric, ', '.join(FOCUS_METRICS)))
+    focus_statistics = [s for s in statistics if s in FOCUS_STATISTICS]
+    if memory_budget is not None and focus_statistics:
+        raise ValueError('{} cannot be computed with a memory budget'.format(
+            ', '.join(focus_statistics)))
+
+    # skip sites that a previous run already completed with the same inputs
+    manifest = ProjectionManifest(
+        path.join(base_dir, output_dir, 'projection_manifest.json'))
+    signatures = {}
+    pending_tasks = []
+    for task in tasks:
+        image_paths, output_paths = manifest_outputs(task, statistics)
+        signature = input_signature(image_paths)
+        if manifest.is_complete(site_key(task), signature, statistics,
+                                output_paths):
+            continue
+        signatures[site_key(task)] = signature
+        pending_tasks.append(task)
+    logger.info('%d of %d sites already completed, projecting %d',
+                len(tasks) - len(pending_tasks), len(tasks),
+                len(pending_tasks))
+    tasks_by_key = dict((site_key(task), task) for task in pending_tasks)
+
+    # per-site timings, and per-plane reads in the pipelined and shared
+    # memory modes, as JSON lines next to the log
+    telemetry_path = path.join(getcwd(), 'StackToMaxSum.jsonl')
+    telemetry_log = setup_telemetry(telemetry_path, 'a')
+
+    n_workers = mp.cpu_count()
+    logger.info('Projecting %d sites with %d workers in %s mode',
+                len(pending_tasks), n_workers, mode)
+
+    pool = None
+    if mode == 'shared_memory':
+        results = project_sites_shared_memory(
+            sites_from_tasks(pending_tasks, statistics),
+            statistics=statistics, n_readers=n_readers, n_reducers=n_workers,
+            focus_metric=focus_metric, edf_window=edf_window)
+    elif mode == 'pipelined':
+        pool = mp.Pool(n_workers)
+        batches = [pending_tasks[i:i + sites_per_batch]
+                   for i in range(0, len(pending_tasks), sites_per_batch)]
+        results = itertools.chain.from_iterable(
+            pool.imap_unordered(
+                functools.partial(project_sites_pipelined,
+                                  statistics=statistics,
+                                  focus_metric=focus_metric,
+                                  edf_window=edf_window),
+                batches))
+    else:
+        pool = mp.Pool(n_workers)
+        results = pool.imap_unordered(
+            functools.partial(project_single_site_checked,
+                              statistics=statistics,
+                              focus_metric=focus_metric,
+                              edf_window=edf_window,
+                              memory_budget=memory_budget),
+            pending_tasks,
+            chunksize=projection_chunksize(len(pending_tasks), n_workers))
+
+    n_failed = 0
+    try:
+        for key, error in results:
+            if error is not None:
+                n_failed += 1
+                continue
+            # the signature taken before scheduling is recorded, so inputs
+            # that change during the run are projected again next time
+            image_paths, output_paths = manifest_outputs(
+                tasks_by_key[key], statistics)
+            manifest.record(key, signatures[key], statistics, output_paths)
+    finally:
+        manifest.save()
+        if pool is not None:
+            pool.close()
+            pool.join()
 
+    logger.info('%d of %d sites failed', n_failed, len(pending_tasks))
+    report_telemetry(telemetry_log, telemetry_path)
 
 if __name__ == "__main__":
     mp.freeze_support()
@@ -0,0 +1,195 @@
+#! /usr/bin/env python
+
+import sys
+import csv
+import json
+import argparse
+from collections import Counter
+from plate_index_db import open_index
+from yokogawa_index import YokogawaFile
+
+REPORT_FIELDS = ('status', 'well', 'site', 'channel', 't', 'z', 'filename')
+
+
+def load_layout(layout_path):
+    '''Reads a plate layout spec from a JSON file.
+
+    The spec is an object with any of
+    wells       list of wells, or {"rows": "BCD", "columns": [7, 8]}
+    sites       number of sites per well, or a list of site numbers
+    channels    list of channels, e.g. ["C01", "C02"], or a mapping of
+                channel to its "L" and "A" fields, {"C02": {"l": "01",
+                "a": "02"}}, used to name missing files
+    z_planes    number of z-planes, or a mapping of channel to number
+    timepoints  number of timepoints
+    stem        file name stem
+
+    Anything that is left out is taken from the images on the plate.
+    '''
+    if layout_path is None:
+        return {}
+    with open(layout_path) as f:
+        layout = json.load(f)
+    wells = layout.get('wells')
+    if isinstance(wells, dict):
+        layout['wells'] = [row + str(col).zfill(2) for row in wells['rows']
+                           for col in wells['columns']]
+    return layout
+
+
+def _numbers(value):
+    # a count n as 1..n, a list as is
+    if isinstance(value, int):
+        return list(range(1, value + 1))
+    return [int(v) for v in value]
+
+
+def plate_layout(index, layout):
+    # the full layout of the plate: the spec where it is given, and the
+    # observed ranges otherwise. Sites run from 1 to the highest site
+    # found, z-planes and timepoints are observed per channel
+    records = list(index.records.values())
+    wells = layout.get('wells') or index.wells()
+    if 'sites' in layout:
+        sites = _numbers(layout['sites'])
+    else:
+        sites = _numbers(max(int(rec.site) for rec in records))
+
+    observed_fields = {}
+    observed_z = {}
+    observed_t = {}
+    for rec in records:
+        observed_fields.setdefault(rec.c, Counter())[(rec.l, rec.a)] += 1
+        observed_z.setdefault(rec.c, set()).add(int(rec.z))
+        observed_t.setdefault(rec.c, set()).add(int(rec.t))
+
+    channels = layout.get('channels') or sorted(observed_fields)
+    fields = {}
+    for c in channels:
+        if isinstance(channels, dict) and channels[c]:
+            fields[c] = (channels[c].get('l', '01'),
+                         channels[c].get('a', '01'))
+        elif c in observed_fields:
+            fields[c] = observed_fields[c].most_common(1)[0][0]
+        else:
+            fields[c] = ('01', '01')
+
+    z_planes = {}
+    timepoints = {}
+    for c in channels:
+        z = layout.get('z_planes')
+        if isinstance(z, dict):
+            z = z.get(c)
+        z_planes[c] = _numbers(z) if z is not None else sorted(
+            observed_z.get(c, [1]))
+        t = layout.get('timepoints')
+        timepoints[c] = _numbers(t) if t is not None else sorted(
+            observed_t.get(c, [1]))
+
+    stem = layout.get('stem')
+    if stem is None:
+        stem = Counter(rec.stem for rec in records).most_common(1)[0][0]
+    return wells, sites, sorted(channels), z_planes, timepoints, fields, stem
+
+
+def audit(index, layout, extension):
+    '''Compares the files of a plate with its layout.
+
+    Returns (missing, unexpected) as sorted lists of (well, site, channel,
+    t, z, filename). Missing files are named after the layout, unexpected
+    files are the images that are not part of it.
+    '''
+    wells, sites, channels, z_planes, timepoints, fields, stem = \
+        plate_layout(index, layout)
+    expected = set(
+        (well, site, c, t, z)
+        for well in wells for site in sites for c in channels
+        for t in timepoints[c] for z in z_planes[c])
+
+    observed = {}
+    for fname, rec in index.records.items():
+        observed[(rec.well, int(rec.site), rec.c, int(rec.t),
+                  int(rec.z))] = fname
+
+    missing = []
+    for key in sorted(expected.difference(observed)):
+        well, site, c, t, z = key
+        l, a = fields[c]
+        fname = YokogawaFile(stem, well, str(t).zfill(4), str(site).zfill(3),
+                             l, a, str(z).zfill(2), c, extension).filename
+        missing.append(key + (fname,))
+    unexpected = [key + (observed[key],)
+                  for key in sorted(set(observed).difference(expected))]
+    return missing, unexpected
+
+
+def write_csv(out, missing, unexpected):
+    writer = csv.writer(out)
+    writer.writerow(REPORT_FIELDS)
+    for status, rows in (('missing', missing), ('unexpected', unexpected)):
+        for row in rows:
+            writer.writerow((status,) + row)
+
+
+def write_json(out, missing, unexpected):
+    # {status: {well: {site: {channel: [filename, ...]}}}}
+    report = {'n_missing': len(missing), 'n_unexpected': len(unexpected)}
+    for status, rows in (('missing', missing), ('unexpected', unexpected)):
+        grouped = report[status] = {}
+        for well, site, c, t, z, fname in rows:
+            grouped.setdefault(well, {}).setdefault(
+                str(site), {}).setdefault(c, []).append(fname)
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='audit_plate',
+        description=('Lists a plate directory once and reports the images'
+                     ' that are missing from, or not part of, the plate'
+                     ' layout, grouped by well, site and channel. The'
+                     ' layout comes from a JSON spec, or from the wells,'
+                     ' sites, channels, z-planes and timepoints found on'
+                     ' the plate. Exits with status 1 if files are'
+                     ' missing.')
+    )
+    parser.add_argument('source_dir', help='path to plate directory')
+    parser.add_argument('--layout', help='JSON layout spec, see load_layout')
+    parser.add_argument('--extension', default='tif',
+                        help='extension of the images')
+    parser.add_argument('--format', choices=('csv', 'json'), default='csv',
+                        help='report format')
+    parser.add_argument('--output', help='report file (default: stdout)')
+    parser.add_argument('--cached-index', action='store_true',
+                        help=('keep a persistent index of the plate directory'
+                              ' and only list it again when it has changed'))
+
+    return(parser.parse_args())
+
+
+def main(args):
+
+    index = open_index(args.source_dir, args.extension, args.cached_index)
+    if not index.records:
+        sys.stderr.write('no CV7000 images found in {}\n'.format(
+            args.source_dir))
+        sys.exit(1)
+    missing, unexpected = audit(index, load_layout(args.layout),
+                                args.extension)
+
+    write_report = write_json if args.format == 'json' else write_csv
+    if args.output:
+        with open(args.output, 'w', newline='') as out:
+            write_report(out, missing, unexpected)
+    else:
+        write_report(sys.stdout, missing, unexpected)
+    sys.stderr.write('{} images, {} missing, {} unexpected\n'.format(
+        len(index), len(missing), len(unexpected)))
+    if missing:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
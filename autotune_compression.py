@@ -0,0 +1,253 @@
+#! /usr/bin/env python
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import functools
+import multiprocessing as mp
+import numpy as np
+import imageio
+import tifffile
+from png_writer import read_gray_tiff, encode_png
+from convert_tiff_to_png import walk_tiff_files, load_config
+
+# (name, codec, options). PNG candidates are the settings that
+# convert_tiff_to_png can use, TIFF candidates are measured for
+# comparison, e.g. for choosing an archive format
+CANDIDATES = (
+    [('png-{}-{}'.format(f, level), 'png',
+      {'compression_level': level, 'png_filter': f})
+     for f in ('none', 'sub', 'up', 'paeth', 'adaptive')
+     for level in (1, 3, 6, 9)] +
+    [('tiff-none', 'tiff', {'compression': None}),
+     ('tiff-deflate-1', 'tiff', {'compression': 'zlib', 'level': 1}),
+     ('tiff-deflate-6', 'tiff', {'compression': 'zlib', 'level': 6}),
+     ('tiff-deflate-6-predictor', 'tiff',
+      {'compression': 'zlib', 'level': 6, 'predictor': True}),
+     ('tiff-lzw-predictor', 'tiff', {'compression': 'lzw', 'predictor': True}),
+     ('tiff-zstd-3-predictor', 'tiff',
+      {'compression': 'zstd', 'level': 3, 'predictor': True}),
+     ('tiff-zstd-9-predictor', 'tiff',
+      {'compression': 'zstd', 'level': 9, 'predictor': True})]
+)
+
+
+# codecs that have been used once in this process
+_warmed_up = set()
+
+
+def encode(image, codec, options):
+    if codec == 'png':
+        return encode_png(image, options['compression_level'],
+                          options['png_filter'])
+    buf = io.BytesIO()
+    compressionargs = None
+    if options.get('level') is not None:
+        compressionargs = {'level': options['level']}
+    tifffile.imwrite(buf, image, compression=options['compression'],
+                     compressionargs=compressionargs,
+                     predictor=options.get('predictor', False))
+    return buf.getvalue()
+
+
+def decode(data, codec):
+    if codec == 'png':
+        return imageio.imread(data, format='png')
+    return tifffile.imread(io.BytesIO(data))
+
+
+def measure_image(image_path, candidates):
+    # encode and decode one image with every candidate. Returns
+    # (image_path, {name: (raw bytes, encoded bytes, encode s, decode s,
+    # error)}, None), or (image_path, None, reason) for images that
+    # cannot be read and TIFFs that the conversion leaves to mogrify
+    try:
+        image = read_gray_tiff(image_path)
+    except Exception as err:
+        return image_path, None, 'cannot be read: {}'.format(err)
+    if image is None:
+        return image_path, None, 'not a grayscale TIFF'
+    results = {}
+    for name, codec, options in candidates:
+        try:
+            if codec not in _warmed_up:
+                # the first call imports and initialises the codec
+                decode(encode(image, codec, options), codec)
+                _warmed_up.add(codec)
+            start = time.time()
+            data = encode(image, codec, options)
+            encode_s = time.time() - start
+            start = time.time()
+            decoded = decode(data, codec)
+            decode_s = time.time() - start
+            if not np.array_equal(decoded, image):
+                raise ValueError('decoded image differs from the original')
+            results[name] = (image.nbytes, len(data), encode_s, decode_s,
+                             None)
+        except Exception as err:
+            # e.g. LZW and zstd need the imagecodecs package
+            results[name] = (image.nbytes, 0, 0.0, 0.0, str(err))
+    return image_path, results, None
+
+
+def sample_tiff_files(source_dir, n_images, seed=0):
+    # reservoir sample of n_images TIFFs from a single pass over the tree
+    rng = random.Random(seed)
+    sample = []
+    for i, (source_path, _) in enumerate(walk_tiff_files(source_dir)):
+        if i < n_images:
+            sample.append(source_path)
+        else:
+            j = rng.randint(0, i)
+            if j < n_images:
+                sample[j] = source_path
+    return sorted(sample)
+
+
+def summarize(measurements, candidates):
+    # totals per candidate over all images
+    summary = []
+    for name, codec, options in candidates:
+        rows = [m[name] for m in measurements]
+        errors = [r[4] for r in rows if r[4] is not None]
+        if errors:
+            summary.append({'name': name, 'codec': codec,
+                            'options': options, 'error': errors[0]})
+            continue
+        raw = sum(r[0] for r in rows)
+        encoded = sum(r[1] for r in rows)
+        encode_s = sum(r[2] for r in rows)
+        decode_s = sum(r[3] for r in rows)
+        summary.append({
+            'name': name, 'codec': codec, 'options': options,
+            'ratio': raw / float(encoded),
+            'encode_mb_per_s': raw / 2.0 ** 20 / max(encode_s, 1e-9),
+            'decode_mb_per_s': raw / 2.0 ** 20 / max(decode_s, 1e-9),
+            'error': None
+        })
+    return summary
+
+
+def format_table(summary):
+    lines = ['{:<28}{:>8}{:>14}{:>14}'.format(
+        'candidate', 'ratio', 'encode MB/s', 'decode MB/s')]
+    measured = sorted((s for s in summary if s['error'] is None),
+                      key=lambda s: -s['ratio'])
+    for s in measured:
+        lines.append('{:<28}{:>8.2f}{:>14.1f}{:>14.1f}'.format(
+            s['name'], s['ratio'], s['encode_mb_per_s'],
+            s['decode_mb_per_s']))
+    for s in summary:
+        if s['error'] is not None:
+            lines.append('{:<28}  unavailable: {}'.format(
+                s['name'], s['error']))
+    return lines
+
+
+def choose_png_setting(summary, min_encode_mb_per_s=0.0,
+                       min_decode_mb_per_s=0.0):
+    # the smallest PNG output among the settings that are fast enough
+    eligible = [s for s in summary
+                if s['codec'] == 'png' and s['error'] is None and
+                s['encode_mb_per_s'] >= min_encode_mb_per_s and
+                s['decode_mb_per_s'] >= min_decode_mb_per_s]
+    if not eligible:
+        return None
+    return max(eligible, key=lambda s: s['ratio'])
+
+
+def write_config(config_path, setting):
+    # update the conversion options in config_path, keeping anything else
+    config = load_config(config_path) if os.path.exists(config_path) else {}
+    config['engine'] = 'native'
+    config.update(setting['options'])
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='autotune_compression',
+        description=('Encodes a random sample of TIFFs from a source tree'
+                     ' with PNG and TIFF compression settings and reports'
+                     ' the compression ratio and the encode and decode'
+                     ' throughput per worker. The chosen PNG setting can'
+                     ' be written to a convert_tiff_to_png --config file.')
+    )
+    parser.add_argument('source_dir', help='path to source directory')
+    parser.add_argument('-n', '--n-images', type=int, default=32,
+                        help='number of images to sample')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the sample')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--candidates', nargs='+',
+                        choices=[c[0] for c in CANDIDATES],
+                        metavar='CANDIDATE',
+                        help='only measure these candidates')
+    parser.add_argument('--min-encode-mb-per-s', type=float, default=0.0,
+                        help='minimum encode throughput of the chosen setting')
+    parser.add_argument('--min-decode-mb-per-s', type=float, default=0.0,
+                        help='minimum decode throughput of the chosen setting')
+    parser.add_argument('--write-config', metavar='CONFIG',
+                        help='write the chosen PNG setting to this file')
+    parser.add_argument('--output', help='write the results as JSON')
+
+    return(parser.parse_args())
+
+
+def main(args):
+
+    candidates = [c for c in CANDIDATES
+                  if args.candidates is None or c[0] in args.candidates]
+    image_paths = sample_tiff_files(args.source_dir, args.n_images,
+                                    args.seed)
+    sys.stderr.write('measuring {} candidates on {} images\n'.format(
+        len(candidates), len(image_paths)))
+
+    pool = mp.Pool(args.workers)
+    measurements = []
+    for image_path, results, reason in pool.imap_unordered(
+            functools.partial(measure_image, candidates=candidates),
+            image_paths):
+        if results is None:
+            sys.stderr.write('skipping {}, {}\n'.format(image_path, reason))
+            continue
+        measurements.append(results)
+    pool.close()
+    pool.join()
+
+    if not measurements:
+        sys.stderr.write('no grayscale TIFFs found in {}\n'.format(
+            args.source_dir))
+        sys.exit(1)
+
+    summary = summarize(measurements, candidates)
+    for line in format_table(summary):
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'images': len(measurements), 'candidates': summary},
+                      f, indent=2)
+
+    if args.write_config:
+        setting = choose_png_setting(summary, args.min_encode_mb_per_s,
+                                     args.min_decode_mb_per_s)
+        if setting is None:
+            sys.stderr.write('no PNG setting meets the throughput limits\n')
+            sys.exit(1)
+        write_config(args.write_config, setting)
+        sys.stderr.write('wrote {} to {}\n'.format(
+            setting['name'], args.write_config))
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    mp.freeze_support()
+    main(args)
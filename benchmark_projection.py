@@ -0,0 +1,292 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import functools
+import subprocess
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import tifffile
+from zprojection import ZProjector, read_plane, save_plane
+
+VARIANTS = ('stacked', 'streaming', 'joblib', 'threads', 'pipelined',
+            'shared_memory', 'tiled')
+
+fname_stub = 'synthetic-plate_'
+timeline_name = 'T0001'
+l_name = 'L01'
+action_name = 'A01'
+input_dir = 'images'
+output_dir = 'projections'
+
+
+def make_synthetic_plate(base_dir, wells, n_sites, z_planes, channels,
+                         shape, seed=0):
+    # write a plate of uncompressed uint16 TIFFs named like CV7000 output
+    # and return the total number of bytes written
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(base_dir, input_dir))
+    os.makedirs(os.path.join(base_dir, output_dir))
+
+    # a handful of distinct planes is enough, cycling them keeps the
+    # generator fast for large plates
+    planes = rng.randint(100, 4000, size=(8,) + shape).astype(np.uint16)
+    n_bytes = 0
+    i = 0
+    for well in wells:
+        for site in range(1, n_sites + 1):
+            for z in range(1, z_planes + 1):
+                for channel in channels:
+                    name = (fname_stub + well + '_' + timeline_name +
+                            'F' + str(site).zfill(3) + l_name +
+                            action_name + 'Z' + str(z).zfill(2) +
+                            channel + '.tif')
+                    tifffile.imwrite(os.path.join(base_dir, input_dir, name),
+                                     planes[i % len(planes)])
+                    n_bytes += planes[0].nbytes
+                    i += 1
+    return n_bytes
+
+
+def plate_tasks(base_dir, wells, n_sites, z_planes, channels):
+    # task tuples in the format used by StackToMaxSum_mp, projecting each
+    # input channel to two output channels
+    return [
+        (base_dir, fname_stub, well, timeline_name, site, l_name,
+         action_name, channel, [channel + 'max', channel + 'sum'],
+         z_planes, input_dir, output_dir)
+        for well in wells
+        for site in range(1, n_sites + 1)
+        for channel in channels
+    ]
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is reported in kilobytes on Linux. For RUSAGE_CHILDREN it
+    # is the peak of the largest terminated worker process
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def run_variant(variant, tasks, n_workers, memory_budget):
+    import StackToMaxSum_mp as stms
+
+    start = time.time()
+    if variant == 'shared_memory':
+        site_results = stms.project_sites_shared_memory(
+            stms.sites_from_tasks(tasks), n_readers=n_workers,
+            n_reducers=n_workers)
+    elif variant == 'joblib':
+        from joblib import Parallel, delayed
+        site_results = Parallel(n_jobs=n_workers)(
+            delayed(stms.project_single_site_checked)(task) for task in tasks)
+    elif variant == 'threads':
+        pool = ThreadPool(n_workers)
+        site_results = pool.map(stms.project_single_site_checked, tasks)
+        pool.close()
+        pool.join()
+    else:
+        pool = mp.Pool(n_workers)
+        if variant == 'pipelined':
+            batches = [tasks[i:i + 16] for i in range(0, len(tasks), 16)]
+            site_results = [r for batch in pool.imap_unordered(
+                stms.project_sites_pipelined, batches) for r in batch]
+        else:
+            if variant == 'stacked':
+                worker = stacked_site
+            else:
+                worker = functools.partial(
+                    stms.project_single_site_checked,
+                    memory_budget=memory_budget if variant == 'tiled' else None)
+            site_results = list(pool.imap_unordered(
+                worker, tasks,
+                chunksize=stms.projection_chunksize(len(tasks), n_workers)))
+        pool.close()
+        pool.join()
+
+    # threads run in this process, whose peak is peak_rss_mb, and the
+    # joblib workers are still alive, so neither has terminated workers
+    # to report on
+    peak_worker_rss = None
+    if variant not in ('threads', 'joblib'):
+        peak_worker_rss = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return {
+        'seconds': time.time() - start,
+        'failed': sum(1 for _, error in site_results if error is not None),
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_worker_rss_mb': peak_worker_rss
+    }
+
+
+def stacked_site(task):
+    # the original concatenate-then-project code path
+    import StackToMaxSum_mp as stms
+    try:
+        stms.project_single_site(*task, streaming=False)
+    except Exception as err:
+        return stms.site_key(task), str(err)
+    return stms.site_key(task), None
+
+
+def time_phases(tasks):
+    # single process, per-phase timing of read, reduce and write
+    import StackToMaxSum_mp as stms
+    phases = {'read': 0.0, 'reduce': 0.0, 'write': 0.0}
+    bytes_read = 0
+    bytes_written = 0
+    for task in tasks:
+        image_paths, output_paths = stms.site_paths(*task)
+
+        start = time.time()
+        planes = [read_plane(p, memmap=False) for p in image_paths]
+        phases['read'] += time.time() - start
+        bytes_read += sum(p.nbytes for p in planes)
+
+        start = time.time()
+        projector = ZProjector(('max', 'sum'))
+        for plane in planes:
+            projector.update(plane)
+        projections = projector.result()
+        phases['reduce'] += time.time() - start
+
+        start = time.time()
+        for statistic, out_path in zip(('max', 'sum'), output_paths):
+            save_plane(out_path, projections[statistic])
+            bytes_written += projections[statistic].nbytes
+        phases['write'] += time.time() - start
+
+    return {
+        'read_s': phases['read'],
+        'reduce_s': phases['reduce'],
+        'write_s': phases['write'],
+        'read_mb_per_s': bytes_read / 2.0 ** 20 / max(phases['read'], 1e-9),
+        'write_mb_per_s':
+            bytes_written / 2.0 ** 20 / max(phases['write'], 1e-9),
+        'sites_per_s': len(tasks) / max(sum(phases.values()), 1e-9)
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='benchmark_projection',
+        description=('Generates a synthetic CV7000 plate in a temporary'
+                     ' directory and times the StackToMaxSum_mp projection'
+                     ' modes on it. Results are printed as JSON.'
+                     ' Input files are read from the page cache after the'
+                     ' first variant, so compare variants within a run.')
+    )
+    parser.add_argument('--wells', type=int, default=2,
+                        help='number of wells')
+    parser.add_argument('--sites', type=int, default=8,
+                        help='number of sites per well')
+    parser.add_argument('--z-planes', type=int, default=16,
+                        help='number of z-planes per site')
+    parser.add_argument('--channels', type=int, default=2,
+                        help='number of channels')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='image width and height in pixels')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(),
+                        help='number of worker processes or threads')
+    parser.add_argument('--memory-budget', type=int, default=16 * 2 ** 20,
+                        help='bytes per site for the tiled variant')
+    parser.add_argument('--variants', nargs='+', default=list(VARIANTS),
+                        choices=VARIANTS, help='variants to benchmark')
+    parser.add_argument('--tmp-dir', default=None,
+                        help='directory in which to create the plate')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the synthetic plate afterwards')
+    parser.add_argument('--output', help='write the JSON report to a file')
+    # used internally to run a single variant in a fresh interpreter
+    parser.add_argument('--run-variant', choices=VARIANTS,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--plate-dir', help=argparse.SUPPRESS)
+
+    return(parser.parse_args())
+
+
+def plate_layout(args):
+    wells = ['B' + str(i).zfill(2) for i in range(2, args.wells + 2)]
+    channels = ['C' + str(i).zfill(2) for i in range(1, args.channels + 1)]
+    return wells, channels
+
+
+def main(args):
+
+    if args.run_variant:
+        # child mode: StackToMaxSum_mp logs to the current directory
+        os.chdir(args.plate_dir)
+        wells, channels = plate_layout(args)
+        tasks = plate_tasks(args.plate_dir, wells, args.sites,
+                            args.z_planes, channels)
+        result = run_variant(args.run_variant, tasks, args.workers,
+                             args.memory_budget)
+        print(json.dumps(result))
+        return
+
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='benchmark_projection-',
+                                dir=args.tmp_dir)
+    os.chdir(work_dir)
+    try:
+        wells, channels = plate_layout(args)
+        start = time.time()
+        n_bytes = make_synthetic_plate(
+            work_dir, wells, args.sites, args.z_planes, channels,
+            (args.size, args.size))
+        generate_s = time.time() - start
+        tasks = plate_tasks(work_dir, wells, args.sites, args.z_planes,
+                            channels)
+
+        report = {
+            'config': {
+                'wells': args.wells, 'sites': args.sites,
+                'z_planes': args.z_planes, 'channels': args.channels,
+                'size': args.size, 'workers': args.workers,
+                'input_mb': n_bytes / 2.0 ** 20, 'generate_s': generate_s
+            },
+            'phases': time_phases(tasks),
+            'variants': {}
+        }
+
+        for variant in args.variants:
+            # each variant runs in a fresh interpreter so that peak RSS is
+            # not inherited from the previous variant and every pool type
+            # starts from the same clean state
+            shutil.rmtree(os.path.join(work_dir, output_dir))
+            os.makedirs(os.path.join(work_dir, output_dir))
+            output = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__),
+                '--run-variant', variant, '--plate-dir', work_dir,
+                '--wells', str(args.wells), '--sites', str(args.sites),
+                '--z-planes', str(args.z_planes),
+                '--channels', str(args.channels),
+                '--workers', str(args.workers),
+                '--memory-budget', str(args.memory_budget)
+            ])
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            result['sites_per_s'] = len(tasks) / result['seconds']
+            result['mb_per_s'] = n_bytes / 2.0 ** 20 / result['seconds']
+            report['variants'][variant] = result
+            sys.stderr.write('{}: {:.1f} sites/s\n'.format(
+                variant, result['sites_per_s']))
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(work_dir)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    mp.freeze_support()
+    main(args)
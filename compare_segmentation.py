@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+import imageio
+from find_empty_sites import (segment_primary, contains_nucleus,
+                              prescreen_site, ENGINES, EMPTY, FULL)
+
+
+def compare_image(image_path, engines):
+    # segment one image with every engine. Returns the label image and
+    # the segmentation time of each engine
+    dapi = imageio.imread(image_path)
+    results = {}
+    for engine in engines:
+        start = time.time()
+        label_image = segment_primary(dapi, engine)
+        results[engine] = (np.asarray(label_image), time.time() - start)
+    return results
+
+
+def differences(reference, other):
+    # (foreground pixels that differ, object counts of both) of two
+    # label images. Label values may differ, the objects must not
+    return (np.count_nonzero((reference > 0) != (other > 0)),
+            len(np.unique(reference[reference > 0])),
+            len(np.unique(other[other > 0])))
+
+
+def check_prescreen(dapi, engine='native'):
+    # pre-screen outcome of one image, and whether it contradicts the
+    # segmentation: an EMPTY site must not contain a nucleus, a FULL one
+    # must
+    outcome = prescreen_site(dapi)[0]
+    if outcome not in (EMPTY, FULL):
+        return outcome, False
+    return outcome, (outcome == EMPTY) == contains_nucleus(dapi, engine)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='compare_segmentation',
+        description=('Segments a set of images with the native and the'
+                     ' jtmodules implementation of find_empty_sites and'
+                     ' checks that both find the same nuclei, or checks the'
+                     ' pre-screen against the segmentation. Exits with'
+                     ' status 1 if any image differs.')
+    )
+    parser.add_argument('source_dir', help='path to source directory')
+    parser.add_argument('--glob', default='*C01.tif',
+                        help='images in source_dir to compare')
+    parser.add_argument('-n', '--n-images', type=int,
+                        help='only compare the first n images')
+    parser.add_argument('--prescreen', action='store_true',
+                        help=('check that every site pre-screened as empty'
+                              ' or full is classified the same by the'
+                              ' native segmentation'))
+
+    return(parser.parse_args())
+
+
+def main(args):
+
+    image_paths = sorted(glob.glob(os.path.join(args.source_dir, args.glob)))
+    if args.n_images is not None:
+        image_paths = image_paths[:args.n_images]
+    if not image_paths:
+        sys.stderr.write('no images matching {} in {}\n'.format(
+            args.glob, args.source_dir))
+        sys.exit(1)
+
+    if args.prescreen:
+        n_wrong = 0
+        for image_path in image_paths:
+            outcome, wrong = check_prescreen(imageio.imread(image_path))
+            if wrong:
+                n_wrong += 1
+                print('{}: pre-screened as {}, segmentation disagrees'.format(
+                    os.path.basename(image_path), outcome))
+        print('{} of {} images pre-screened wrongly'.format(
+            n_wrong, len(image_paths)))
+        if n_wrong:
+            sys.exit(1)
+        return
+
+    reference, candidate = 'jtmodules', 'native'
+    seconds = dict((engine, 0.0) for engine in ENGINES)
+    n_different = 0
+    for image_path in image_paths:
+        results = compare_image(image_path, (reference, candidate))
+        for engine in results:
+            seconds[engine] += results[engine][1]
+        pixels, n_reference, n_candidate = differences(
+            results[reference][0], results[candidate][0])
+        if pixels or n_reference != n_candidate:
+            n_different += 1
+            print('{}: {} pixels differ, {} {} objects, {} {} objects'.format(
+                os.path.basename(image_path), pixels, n_reference,
+                reference, n_candidate, candidate))
+
+    for engine in (reference, candidate):
+        print('{:<10} {:8.3f} s per image'.format(
+            engine, seconds[engine] / len(image_paths)))
+    print('{} of {} images differ'.format(n_different, len(image_paths)))
+    if n_different:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import threading
+
+
+def file_digest(file_path, block_size=2 ** 20):
+    # sha1 of the file contents, read in blocks
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ConversionManifest(object):
+    '''Record of the TIFFs that have been converted or have failed.
+
+    Entries are keyed by the TIFF path relative to the source directory
+    and store the size and mtime of the TIFF, the size of the PNG that
+    was written and, optionally, a sha1 of the TIFF. Every conversion is
+    appended as one JSON line as soon as it finishes, and the last line
+    for a file wins, so an interrupted run loses at most one entry and
+    the manifest never has to be rewritten while converting. Files whose
+    last conversion failed form the retry list of the next run. close()
+    compacts the manifest to one line per file.
+    '''
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.entries = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by an interrupted run
+                        continue
+                    self.entries[entry['tiff']] = entry
+        self._lock = threading.Lock()
+        self._file = open(manifest_path, 'a')
+
+    def failed(self):
+        return sorted(k for k, e in self.entries.items() if e['failed'])
+
+    def is_current(self, key, source_stat, png_path, source_path=None,
+                   check_hash=False):
+        # True if the PNG of the TIFF at key is up to date
+        try:
+            png_stat = os.stat(png_path)
+        except OSError:
+            return False
+
+        entry = self.entries.get(key)
+        if entry is None:
+            # converted before there was a manifest: trust a non-empty
+            # PNG that is not older than its TIFF
+            return (png_stat.st_size > 0 and
+                    png_stat.st_mtime >= source_stat.st_mtime)
+        if entry['failed'] or entry['png_size'] != png_stat.st_size:
+            return False
+        if (entry['size'] == source_stat.st_size and
+                entry['mtime'] == source_stat.st_mtime):
+            return True
+        if (check_hash and entry.get('sha1') is not None and
+                entry['size'] == source_stat.st_size and
+                file_digest(source_path) == entry['sha1']):
+            # same contents with a new mtime, e.g. after a copy
+            self.record(key, source_stat, png_stat.st_size, entry['sha1'])
+            return True
+        return False
+
+    def record(self, key, source_stat, png_size=None, sha1=None,
+               failed=False):
+        entry = {
+            'tiff': key,
+            'size': source_stat.st_size,
+            'mtime': source_stat.st_mtime,
+            'png_size': png_size,
+            'sha1': sha1,
+            'failed': failed
+        }
+        with self._lock:
+            self.entries[key] = entry
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def close(self):
+        # rewrite with one line per file and rename into place
+        with self._lock:
+            self._file.close()
+            tmp_path = self.manifest_path + '.tmp-{}'.format(os.getpid())
+            with open(tmp_path, 'w') as f:
+                for key in sorted(self.entries):
+                    f.write(json.dumps(self.entries[key]) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.manifest_path)
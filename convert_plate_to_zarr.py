@@ -0,0 +1,259 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import time
+import warnings
+import logging
+import argparse
+import functools
+import multiprocessing as mp
+import numpy as np
+import zarr
+from numcodecs import Blosc
+from MultiProcessingLog import MultiProcessingLog
+from tiff_memmap import imread_memmap
+from plate_index_db import open_index
+from task_telemetry import (TaskTimer, phase, add_bytes, setup_telemetry,
+                            report_telemetry)
+
+warnings.filterwarnings('ignore')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+NGFF_VERSION = '0.4'
+SHUFFLES = {'none': Blosc.NOSHUFFLE, 'byte': Blosc.SHUFFLE,
+            'bit': Blosc.BITSHUFFLE}
+
+
+# OME-NGFF 0.4 is stored in the zarr v2 format with '/' separated chunk
+# keys, which zarr 3 only writes when asked to and spells differently
+ZARR_3 = int(zarr.__version__.split('.')[0]) >= 3
+
+
+def open_plate_group(store_path):
+    if ZARR_3:
+        return zarr.open_group(store_path, mode='a', zarr_format=2)
+    return zarr.open_group(store_path, mode='a')
+
+
+def require_site_array(group, shape, chunks, dtype, compressor):
+    if ZARR_3:
+        return group.require_array(
+            '0', shape=shape, chunks=chunks, dtype=dtype,
+            compressors=compressor, fill_value=0,
+            chunk_key_encoding={'name': 'v2', 'separator': '/'})
+    return group.require_dataset(
+        '0', shape=shape, chunks=chunks, dtype=dtype,
+        compressor=compressor, fill_value=0, dimension_separator='/')
+
+
+def index_plate(source_dir, cached=False):
+    # one listing of source_dir, grouped into
+    # {well: {site: {(t, c, z): filename}}}, plus the sorted timepoints,
+    # channels and z-planes found on the whole plate
+    index = open_index(source_dir, 'tif', cached)
+    plate = {}
+    stem = None
+    for well, site in index.sites():
+        files = plate.setdefault(well, {}).setdefault(site, {})
+        for fname in index.site_files(well, site):
+            rec = index.records[fname]
+            stem = rec.stem
+            files[(int(rec.t), rec.c, int(rec.z))] = fname
+    return (plate, index.timepoints(), index.channels(), index.z_planes(),
+            stem)
+
+
+def write_plate_metadata(root, plate, channels, name):
+    rows = sorted(set(well[0] for well in plate))
+    columns = sorted(set(well[1:] for well in plate))
+    root.attrs['plate'] = {
+        'version': NGFF_VERSION,
+        'name': name,
+        'rows': [{'name': r} for r in rows],
+        'columns': [{'name': c} for c in columns],
+        'wells': [
+            {'path': well[0] + '/' + well[1:],
+             'rowIndex': rows.index(well[0]),
+             'columnIndex': columns.index(well[1:])}
+            for well in sorted(plate)
+        ],
+        'field_count': max(len(sites) for sites in plate.values())
+    }
+
+
+def create_site_arrays(root, plate, shape, dtype, chunks, compressor,
+                       channels):
+    # groups, metadata and empty arrays are created up front by the
+    # parent, so that workers only ever write chunks of their own site.
+    # Returns (well, site, array path) for every site
+    axes = [{'name': 't', 'type': 'time'},
+            {'name': 'c', 'type': 'channel'},
+            {'name': 'z', 'type': 'space'},
+            {'name': 'y', 'type': 'space'},
+            {'name': 'x', 'type': 'space'}]
+    sites = []
+    for well in sorted(plate):
+        well_group = root.require_group(well[0]).require_group(well[1:])
+        site_numbers = sorted(plate[well])
+        well_group.attrs['well'] = {
+            'version': NGFF_VERSION,
+            'images': [{'path': str(i)} for i in range(len(site_numbers))]
+        }
+        for i, site in enumerate(site_numbers):
+            image = well_group.require_group(str(i))
+            image.attrs['multiscales'] = [{
+                'version': NGFF_VERSION,
+                'axes': axes,
+                'datasets': [{
+                    'path': '0',
+                    'coordinateTransformations': [
+                        {'type': 'scale', 'scale': [1.0] * 5}]
+                }]
+            }]
+            image.attrs['omero'] = {
+                'channels': [{'label': c, 'active': True} for c in channels]
+            }
+            # NGFF field paths are consecutive, keep the Yokogawa number
+            image.attrs['yokogawa_site'] = site
+            require_site_array(image, shape, chunks, dtype, compressor)
+            sites.append((well, site, '/'.join([well[0], well[1:], str(i),
+                                                '0'])))
+    return sites
+
+
+def export_site(store_path, array_path, source_dir, files, timepoints,
+                channels, z_planes):
+    # write every plane of one site. Planes are buffered up to the z
+    # chunk size so that each chunk is written exactly once
+    array = zarr.open_array(os.path.join(store_path, array_path), mode='r+')
+    z_chunk = array.chunks[2]
+    for ti, t in enumerate(timepoints):
+        for ci, c in enumerate(channels):
+            for z0 in range(0, len(z_planes), z_chunk):
+                block = np.zeros(
+                    (min(z_chunk, len(z_planes) - z0),) + array.shape[3:],
+                    dtype=array.dtype)
+                with phase('read'):
+                    for zi, z in enumerate(z_planes[z0:z0 + z_chunk]):
+                        fname = files.get((t, c, z))
+                        if fname is None:
+                            logger.warning('%s: no image for T%d %s Z%02d,'
+                                           ' left empty', array_path, t, c, z)
+                            continue
+                        block[zi] = imread_memmap(
+                            os.path.join(source_dir, fname))
+                        add_bytes(read=block[zi].nbytes)
+                with phase('write'):
+                    array[ti, ci, z0:z0 + len(block)] = block
+                add_bytes(written=block.nbytes)
+
+
+def export_site_checked(task, store_path, source_dir, timepoints, channels,
+                        z_planes):
+    well, site, array_path, files = task
+    key = '{}_F{}'.format(well, str(site).zfill(3))
+    with TaskTimer('export_zarr', key) as timer:
+        try:
+            logger.info('%s, writing %s', key, array_path)
+            export_site(store_path, array_path, source_dir, files,
+                        timepoints, channels, z_planes)
+        except Exception as err:
+            logger.error('%s, export failed: %s', key, err)
+            timer.error = str(err)
+    return key, timer.error
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='convert_plate_to_zarr',
+        description=('Writes all CV7000 TIFFs of a plate into one chunked,'
+                     ' compressed OME-Zarr (NGFF 0.4) plate with'
+                     ' plate/row/column/field groups and a (t, c, z, y, x)'
+                     ' array per field. Every site is written by a single'
+                     ' worker, so no locking is needed.')
+    )
+    parser.add_argument('source_dir', help='path to source directory')
+    parser.add_argument('output_path', help='path of the .zarr to create')
+    parser.add_argument('--chunks', type=int, nargs=2, metavar=('Y', 'X'),
+                        help='chunk height and width (default: full plane)')
+    parser.add_argument('--z-chunk', type=int, default=1,
+                        help='z-planes per chunk')
+    parser.add_argument('--cname', default='zstd',
+                        choices=('zstd', 'lz4', 'lz4hc', 'zlib', 'blosclz'),
+                        help='Blosc compressor')
+    parser.add_argument('--clevel', type=int, default=5, choices=range(10),
+                        metavar='{0-9}', help='Blosc compression level')
+    parser.add_argument('--shuffle', default='bit', choices=sorted(SHUFFLES),
+                        help='Blosc shuffle filter')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--cached-index', action='store_true',
+                        help=('keep a persistent index of the source directory'
+                              ' and only list it again when it has changed'))
+
+    return(parser.parse_args())
+
+
+def main(args):
+
+    # setup logging, next to the store
+    out_dir = os.path.dirname(os.path.abspath(args.output_path))
+    log_stem = os.path.join(
+        out_dir, 'zarr_export-' + time.strftime('%Y%m%d-%H%M%S'))
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+    mp_log = MultiProcessingLog(log_stem + '.log', 'w', 0, 0)
+    mp_log.setFormatter(formatter)
+    logger.addHandler(mp_log)
+    telemetry_path = log_stem + '.jsonl'
+    telemetry_log = setup_telemetry(telemetry_path)
+
+    plate, timepoints, channels, z_planes, stem = index_plate(args.source_dir,
+                                                            args.cached_index)
+    if not plate:
+        logger.error('no CV7000 images found in %s', args.source_dir)
+        sys.exit(1)
+    logger.info('found %d wells, %d timepoints, channels %s, %d z-planes',
+                len(plate), len(timepoints), ', '.join(channels),
+                len(z_planes))
+
+    first_site = next(iter(next(iter(plate.values())).values()))
+    sample = imread_memmap(
+        os.path.join(args.source_dir, next(iter(first_site.values()))))
+    plane_shape = sample.shape[-2:]
+    shape = (len(timepoints), len(channels), len(z_planes)) + plane_shape
+    chunks = (1, 1, min(args.z_chunk, len(z_planes))) + tuple(
+        args.chunks if args.chunks else plane_shape)
+    compressor = Blosc(cname=args.cname, clevel=args.clevel,
+                       shuffle=SHUFFLES[args.shuffle])
+
+    root = open_plate_group(args.output_path)
+    write_plate_metadata(root, plate, channels, stem)
+    sites = create_site_arrays(root, plate, shape, sample.dtype, chunks,
+                               compressor, channels)
+    tasks = [(well, site, array_path, plate[well][site])
+             for well, site, array_path in sites]
+    logger.info('exporting %d sites of shape %s in chunks of %s',
+                len(tasks), shape, chunks)
+
+    pool = mp.Pool(args.workers)
+    results = pool.imap_unordered(
+        functools.partial(export_site_checked, store_path=args.output_path,
+                          source_dir=args.source_dir, timepoints=timepoints,
+                          channels=channels, z_planes=z_planes),
+        tasks)
+    n_failed = sum(1 for key, error in results if error is not None)
+    pool.close()
+    pool.join()
+
+    logger.info('%d of %d sites failed', n_failed, len(tasks))
+    report_telemetry(telemetry_log, telemetry_path)
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    mp.freeze_support()
+    main(args)
@@ -1,37 +1,192 @@
+import sys
+import json
 import time
 import warnings
 import logging
 import argparse
+import functools
 import multiprocessing as mp
-from os import path, makedirs, walk
-from subprocess import check_call, CalledProcessError
+from os import path, makedirs, scandir, stat
+from subprocess import check_call
 from MultiProcessingLog import MultiProcessingLog
+from png_writer import read_gray_tiff, encode_png, write_png, PNG_FILTERS
+from conversion_manifest import ConversionManifest, file_digest
+from worker_profiling import (profiling_pool_args, merge_profiles,
+                              merge_allocations)
+from task_telemetry import (timed_task, phase, add_bytes, set_error,
+                            file_size, setup_telemetry, report_telemetry)
 
 warnings.filterwarnings('ignore')
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def convert_single_image(source_path, target_dir):
+ENGINES = ('native', 'mogrify')
 
-    logger.info('Converting %s to PNG in %s', source_path, target_dir)
-    try:
+# files handed to a worker at a time. The total is not known while the
+# tree is still being walked, and a conversion takes far longer than
+# the IPC, so a small fixed chunk keeps all workers busy
+discovery_chunksize = 4
+
+
+def convert_with_mogrify(source_path, target_dir):
+    with phase('subprocess'):
         check_call(
             ['mogrify','-depth', '16',
              '-colorspace', 'gray', '-format','png',
              '-path', target_dir, source_path]
         )
-    except (CalledProcessError, OSError) as err:
+
+
+def convert_native(source_path, target_path, level, png_filter):
+    # decode and encode in-process, avoiding an ImageMagick process per
+    # file. Returns False for TIFFs that only ImageMagick can convert
+    with phase('read'):
+        image = read_gray_tiff(source_path)
+    if image is None:
+        return False
+    with phase('compute'):
+        data = encode_png(image, level, png_filter)
+    with phase('write'):
+        write_png(target_path, data)
+    return True
+
+
+@timed_task('convert_tiff_to_png')
+def convert_single_image(source_path, target_dir, engine='native',
+                         level=6, png_filter='up'):
+
+    logger.info('Converting %s to PNG in %s', source_path, target_dir)
+    target_path = png_path(source_path, target_dir)
+    try:
+        if engine == 'mogrify':
+            convert_with_mogrify(source_path, target_dir)
+        elif not convert_native(source_path, target_path, level, png_filter):
+            logger.info('%s is not a single-plane grayscale TIFF,'
+                        ' converting it with mogrify', source_path)
+            engine = 'mogrify'
+            convert_with_mogrify(source_path, target_dir)
+    except Exception as err:
         logger.error(
-            'Mogrify failed to convert %s, %s',
-            source_path, err
+            'Failed to convert %s with %s, %s',
+            source_path, engine, err
         )
+        set_error(str(err))
         return -1
 
+    add_bytes(read=file_size(source_path), written=file_size(target_path))
     return 0
 
 
-def convert_single_site_star(args):
-    return convert_single_image(*args)
+def convert_single_site_star(args, hash_sources=False, **kwargs):
+    # returns what the parent records in the conversion manifest
+    source_path, target_dir = args
+    result = convert_single_image(source_path, target_dir, **kwargs)
+    if result != 0:
+        return source_path, result, None, None
+    png_size = file_size(png_path(source_path, target_dir))
+    digest = file_digest(source_path) if hash_sources else None
+    return source_path, result, png_size, digest
+
+
+def png_path(source_path, target_dir):
+    return path.join(
+        target_dir, path.splitext(path.basename(source_path))[0] + '.png')
+
+
+def walk_tiff_files(source_dir, skip_dir=None):
+    # yield (source_path, rel_dir) for every TIFF below source_dir as
+    # soon as it is found, without descending into skip_dir
+    if skip_dir is not None:
+        skip_dir = path.realpath(skip_dir)
+    pending = ['']
+    while pending:
+        rel_dir = pending.pop()
+        source = path.join(source_dir, rel_dir)
+        try:
+            entries = scandir(source)
+        except OSError as err:
+            logger.error('cannot list %s, %s', source, err)
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if path.realpath(entry.path) != skip_dir:
+                        pending.append(path.join(rel_dir, entry.name))
+                elif entry.name.endswith('.tif'):
+                    yield entry.path, rel_dir
+
+
+def find_tiff_files(source_dir, output_dir):
+    # yield (source_path, target_dir) for every TIFF below source_dir,
+    # re-creating the directory structure in output_dir. Directories are
+    # only created once they are known to contain a TIFF, and output_dir
+    # itself is never searched. If a directory cannot be created, its
+    # TIFFs are still yielded and fail when they are written
+    created = set()
+    for source_path, rel_dir in walk_tiff_files(source_dir, output_dir):
+        target_dir = path.join(output_dir, rel_dir)
+        if rel_dir not in created:
+            if not path.exists(target_dir):
+                logger.info('creating output directory: %s', target_dir)
+                try:
+                    makedirs(target_dir, exist_ok=True)
+                except OSError as err:
+                    logger.warning('cannot create output directory %s, %s',
+                                   target_dir, err)
+            created.add(rel_dir)
+        yield source_path, target_dir
+
+
+def pending_conversions(source_dir, output_dir, manifest, signatures,
+                        counts, incremental=False, check_hash=False):
+    # failures of the previous run are retried first, then the tree is
+    # walked. In incremental mode, files whose PNG is up to date are
+    # skipped. The stat of every scheduled TIFF is kept in signatures
+    # until its result is recorded
+    retried = set()
+    for key in manifest.failed():
+        source_path = path.join(source_dir, key)
+        try:
+            signatures[source_path] = stat(source_path)
+        except OSError:
+            logger.warning('%s failed in the previous run and no longer'
+                           ' exists', source_path)
+            continue
+        target_dir = path.join(output_dir, path.dirname(key))
+        try:
+            makedirs(target_dir, exist_ok=True)
+        except OSError as err:
+            logger.warning('cannot create output directory %s, %s',
+                           target_dir, err)
+        retried.add(key)
+        counts['retried'] += 1
+        yield source_path, target_dir
+
+    for source_path, target_dir in find_tiff_files(source_dir, output_dir):
+        key = path.relpath(source_path, source_dir)
+        if key in retried:
+            continue
+        try:
+            source_stat = stat(source_path)
+        except OSError as err:
+            # removed or renamed since the walk listed it
+            logger.warning('cannot stat %s, %s', source_path, err)
+            counts['failed'] += 1
+            continue
+        if incremental and manifest.is_current(
+                key, source_stat, png_path(source_path, target_dir),
+                source_path, check_hash):
+            counts['skipped'] += 1
+            continue
+        signatures[source_path] = source_stat
+        yield source_path, target_dir
+
+
+def load_config(config_path):
+    # JSON object of option defaults, e.g. as written by
+    # autotune_compression.py, keyed like the command line options
+    with open(config_path) as f:
+        return json.load(f)
 
 
 def parse_arguments():
@@ -46,69 +201,131 @@ def parse_arguments():
         '-v', '--verbosity', action='count', default=0,
         help='increase logging verbosity'
     )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help=('profile the worker processes with cProfile and write the'
+              ' merged stats next to the log')
+    )
+    parser.add_argument(
+        '--profile-memory', action='store_true',
+        help=('profile the workers and also trace their memory'
+              ' allocations with tracemalloc')
+    )
+    parser.add_argument(
+        '--engine', choices=ENGINES, default='native',
+        help=('convert in-process (native) or with ImageMagick mogrify.'
+              ' The native engine falls back to mogrify for TIFFs that'
+              ' are not single-plane 8 or 16-bit grayscale')
+    )
+    parser.add_argument(
+        '--compression-level', type=int, default=6, choices=range(10),
+        metavar='{0-9}', help='zlib level of the native engine'
+    )
+    parser.add_argument(
+        '--png-filter', choices=PNG_FILTERS, default='up',
+        help='PNG row filter of the native engine'
+    )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help=('skip TIFFs whose PNG exists and matches the size and mtime'
+              ' recorded when it was converted')
+    )
+    parser.add_argument(
+        '--hash', action='store_true',
+        help=('record a sha1 of every converted TIFF and, in incremental'
+              ' mode, skip TIFFs whose mtime changed but whose contents'
+              ' did not')
+    )
+    parser.add_argument(
+        '--config',
+        help=('JSON file with defaults for the options above, e.g.'
+              ' {"compression_level": 3, "png_filter": "sub"}; options'
+              ' given on the command line take precedence')
+    )
     parser.add_argument('source_dir', help='path to source directory')
     parser.add_argument('output_dir', help='path to output directory')
 
-    return(parser.parse_args())
+    args = parser.parse_args()
+    if args.config:
+        if not path.isfile(args.config):
+            parser.error('no config file {}'.format(args.config))
+        config = load_config(args.config)
+        unknown = [k for k in config if not hasattr(args, k) or
+                   k in ('config', 'source_dir', 'output_dir')]
+        if unknown:
+            parser.error('unknown option(s) in {}: {}'.format(
+                args.config, ', '.join(sorted(unknown))))
+        # defaults are not checked against choices by argparse
+        for action in parser._actions:
+            if (action.dest in config and action.choices is not None and
+                    config[action.dest] not in action.choices):
+                parser.error('invalid {} in {}: {!r}'.format(
+                    action.dest, args.config, config[action.dest]))
+        parser.set_defaults(**config)
+        args = parser.parse_args()
+    return(args)
 
 
 def main(args):
 
     # setup logging
     formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-    mp_log = MultiProcessingLog(
-        path.join(args.output_dir,
-                  'png_conversion-' +
-                  time.strftime('%Y%m%d-%H%M%S') +
-                  '.log'),
-        'w', 0, 0
-    )
+    log_stem = path.join(args.output_dir,
+                         'png_conversion-' + time.strftime('%Y%m%d-%H%M%S'))
+    mp_log = MultiProcessingLog(log_stem + '.log', 'w', 0, 0)
     mp_log.setFormatter(formatter)
     logger.addHandler(mp_log)
 
-    tiff_paths = []
-    output_dirs = []
-
-    # find tiff files and keep track of the source directory structure
-    for root, dirs, files in walk(args.source_dir):
-        for fyle in files:
-            if fyle.endswith('.tif'):
-                tiff_paths.append(path.join(root, fyle))
-                
-                # Hack to catch inputs ending with and without a /
-                if args.source_dir.endswith('/'):
-                    soure_path_length = len(args.source_dir)
-                else:
-                    soure_path_length = len(args.source_dir) + 1
-                output_dirs.append(
-                    path.join(args.output_dir, root[soure_path_length:])
-                )
-
-    # re-create the directory structure in output_dir
-    unique_dirs = list(set(output_dirs))
-    logger.info(
-        'found %d TIFF files in subfolders: %s',
-        len(tiff_paths),
-        unique_dirs)
-    for d in unique_dirs:
-        if not path.exists(d):
-            logger.info('creating output directory: %s',d)
-            makedirs(d)
-        else:
-            logger.info('output directory %s already exists',d)
-
-    # generate list of tuples containing input/output pairs
-    convert_args = zip(tiff_paths, output_dirs)
-
-    # use a multi-processing pool to get the work done
-    pool = mp.Pool()
-    pool.map(
-        convert_single_site_star,
-        convert_args
+    # per-image timings as JSON lines next to the log
+    telemetry_path = log_stem + '.jsonl'
+    telemetry_log = setup_telemetry(telemetry_path)
+
+    # optionally profile the workers, where the actual work happens
+    profile_dir = None
+    if args.profile or args.profile_memory:
+        profile_dir = log_stem + '-profile'
+
+    # use a multi-processing pool to get the work done. Conversions start
+    # as soon as the first files are found, the pool consumes the walk
+    # lazily while the workers are busy
+    pool = mp.Pool(**profiling_pool_args(profile_dir, args.profile_memory))
+    manifest = ConversionManifest(
+        path.join(args.output_dir, 'png_conversion_manifest.jsonl'))
+    signatures = {}
+    counts = {'skipped': 0, 'retried': 0, 'converted': 0, 'failed': 0}
+    results = pool.imap_unordered(
+        functools.partial(convert_single_site_star, hash_sources=args.hash,
+                          engine=args.engine, level=args.compression_level,
+                          png_filter=args.png_filter),
+        pending_conversions(args.source_dir, args.output_dir, manifest,
+                            signatures, counts, args.incremental, args.hash),
+        chunksize=discovery_chunksize
     )
-    pool.close()
-    pool.join()
+    try:
+        for source_path, result, png_size, digest in results:
+            key = path.relpath(source_path, args.source_dir)
+            source_stat = signatures.pop(source_path)
+            if result == 0:
+                counts['converted'] += 1
+                manifest.record(key, source_stat, png_size, digest)
+            else:
+                # failures are retried first by the next run
+                counts['failed'] += 1
+                manifest.record(key, source_stat, failed=True)
+    finally:
+        pool.close()
+        pool.join()
+        manifest.close()
+
+    summary = ('{converted} converted, {skipped} skipped, {failed} failed'
+               ' ({retried} retried from the previous run)'.format(**counts))
+    logger.info(summary)
+    sys.stderr.write(summary + '\n')
 
+    if profile_dir is not None:
+        merge_profiles(profile_dir, log_stem + '.pstats')
+        merge_allocations(profile_dir, log_stem + '-allocations.txt')
+    report_telemetry(telemetry_log, telemetry_path)
     return
 
 
@@ -2,13 +2,11 @@ import time
 import logging
 import argparse
 import os
-import re
-import glob
+import sys
 import random
-
-yokogawa_pattern = (r'(?P<stem>.+)_(?P<well>[A-Z]\d{2})_T(?P<t>\d+)' +
-                    r'F(?P<site>\d+)L(?P<l>\d+)A(?P<a>\d+)Z(?P<z>\d+)' +
-                    r'(?P<c>[C]\d{2})\.')
+import file_operations
+from multiprocessing.pool import ThreadPool
+from yokogawa_index import YokogawaIndex
 
 
 def parse_arguments():
@@ -22,6 +20,11 @@ def parse_arguments():
     parser.add_argument(
         'plates_dir',
         help='path to directory containing plate subfolders')
+    parser.add_argument(
+        '--seed', type=int,
+        help=('random seed for choosing donor plates (default: a new one,'
+              ' a resumed run reuses the seed recorded in the journal)'))
+    file_operations.add_plan_arguments(parser)
 
     return(parser.parse_args())
 
@@ -41,25 +44,33 @@ def initialise_logger(log_dir):
     fh.setFormatter(formatter)
     logger.addHandler(fh)
 
-    print "Writing log file to {}".format(log_file)
+    print("Writing log file to {}".format(log_file))
 
     return(logger)
 
 
-def list_all_files_for_well(src_dir, well):
-    search_string = (r'(?P<stem>.+)_' +
-                     well +
-                     r'_T(?P<t>\d+)' +
-                     r'F\d+' +
-                     r'L\d+A\d+Z(?P<z>\d+)(?P<c>[C]\d{2})\.')
-    files = [f for f in os.listdir(src_dir) if re.match(search_string, f)]
-    return files
+def scan_plate(image_folder):
+    # list an "images" folder once. Returns all file names, including
+    # non-image files, and an index of the CV7000 images in it. Hidden
+    # files are left out, a plate index database must not be linked
+    # into the filled plate, which would then share it
+    with os.scandir(image_folder) as entries:
+        names = [entry.name for entry in entries
+                 if not entry.name.startswith('.')]
+    return names, YokogawaIndex(image_folder, names=names)
 
 
 def main(args):
 
     logger = initialise_logger(args.plates_dir)
 
+    # record of the links that were created, to resume or roll back
+    journal_path = os.path.join(args.plates_dir,
+                                'extend_plates_to_full_size-journal.tsv')
+    if args.rollback:
+        sys.exit(1 if file_operations.rollback_journal(
+            journal_path, logger) else 0)
+
     # find all "images" directories
     logger.info('Scanning source directory for "images" folders')
     images_paths = []
@@ -68,18 +79,27 @@ def main(args):
             if (name == "images"):
                 logger.info("Found image folder %s",os.path.join(root, name))
                 images_paths.append(os.path.join(root, name))
-
-    # scan "images" directories and find which wells exist
+        # image folders are listed by scan_plate, not by the walk, and
+        # plates filled by an earlier run are not plates of their own
+        dirs[:] = [name for name in dirs
+                   if name != "images" and not name.endswith("_filled")]
+
+    # list all "images" directories concurrently, each exactly once
+    logger.info('Scanning %d image folders', len(images_paths))
+    pool = ThreadPool(args.threads)
+    scans = dict(zip(images_paths, pool.map(scan_plate, images_paths)))
+    pool.close()
+    pool.join()
+
+    # find which wells exist
     plate_wells = []
     for image_folder in images_paths:
-        logger.info('Scanning %s for images',image_folder)
-        files = [os.path.basename(full_path)
-                 for full_path in glob.glob(image_folder + '/*C01.png')]
+        names, index = scans[image_folder]
 
         # get unique wells
-        well_names = [m.group('well') for f in files
-                      for m in [re.match(yokogawa_pattern,f)] if m]
-        unique_wells = sorted(list(set(well_names)))
+        unique_wells = sorted(set(
+            rec.well for rec in index.records.values()
+            if rec.c == 'C01' and rec.ext == 'png'))
         logger.info('In %s, found %d wells',image_folder,len(unique_wells))
         logger.info('Wells: {}'.format(', '.join(unique_wells)))
         plate_wells.append([image_folder, unique_wells])
@@ -100,6 +120,14 @@ def main(args):
 
     # for each plate with missing wells,
     # replace the missing wells with randomly chosen wells
+    # the seed is kept in the journal, a resumed run makes the same choices
+    try:
+        seed = file_operations.journal_seed(journal_path, args.seed, logger)
+    except ValueError as err:
+        logger.error('%s', err)
+        sys.exit(str(err))
+    random.seed(seed)
+    operations = []
     for images_path, wells in missing_plate_wells:
         logger.info('Missing wells in plate {} : {}'.format(
             images_path,' ,'.join(wells))
@@ -108,10 +136,6 @@ def main(args):
         root, plate_name = os.path.split(plate_path)
         filled_plate_path = os.path.join(root,plate_name + '_filled','images')
 
-        logger.info('Creating path {}'.format(filled_plate_path))
-        if not os.path.exists(filled_plate_path):
-            os.makedirs(filled_plate_path)
-
         for well in wells:
             # generate a list of plates that contain the current well
             # and select one randomly
@@ -119,43 +143,30 @@ def main(args):
             random_plate_path = random.choice(available_plate_paths)
 
             # get a list of all files from the current well in the random plate
-            src_files = list_all_files_for_well(random_plate_path, well)
+            src_files = scans[random_plate_path][1].select(well=well)
             logger.info('Found {} images for well {} on plate {}'.format(
                 len(src_files),well,random_plate_path))
 
-            # create hard links in the new "filled"
-            # folder from the chosen files
+            # hard links in the new "filled" folder to the chosen files
             for src_file in src_files:
-
-                src_path = os.path.join(random_plate_path, src_file)
-                dest_path = os.path.join(filled_plate_path, src_file)
-
-                logger.info('Linking {} to {}'.format(
-                    src_path, dest_path))
-
-                if not os.path.isfile(dest_path):
-                    os.link(src_path, dest_path)
-                else:
-                    logger.warn(
-                        'Destination file {} already exists'.format(dest_path)
-                    )
+                operations.append(file_operations.link(
+                    os.path.join(random_plate_path, src_file),
+                    os.path.join(filled_plate_path, src_file)))
 
         # also link the original "non-missing" image files
-        nonmissing_files = os.listdir(images_path)
+        nonmissing_files = scans[images_path][0]
         for src_file in nonmissing_files:
-            src_path = os.path.join(images_path, src_file)
-            dest_path = os.path.join(filled_plate_path, src_file)
-
-            logger.info('Linking original {} to {}'.format(
-                src_path, dest_path))
-
-            if not os.path.isfile(dest_path):
-                os.link(src_path, dest_path)
-            else:
-                logger.warn(
-                    'Destination file {} already exists'.format(dest_path)
-                )
-
+            operations.append(file_operations.link(
+                os.path.join(images_path, src_file),
+                os.path.join(filled_plate_path, src_file)))
+
+    # validate and create all links, the filled folders are created as
+    # needed
+    n_failed = file_operations.run_plan(
+        operations, journal_path, args.dry_run, args.threads, args.strict,
+        logger, seed)
+    if n_failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     args = parse_arguments()
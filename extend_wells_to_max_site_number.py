@@ -3,37 +3,19 @@ import warnings
 import logging
 import argparse
 import os
-import re
-import glob
+import sys
 import random
+import file_operations
 from operator import itemgetter
+from plate_index_db import open_index
 
 warnings.filterwarnings('ignore')
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-pattern = (r'(?P<stem>.+)_(?P<well>[A-Z]\d{2})_T(?P<t>\d+)' +
-           r'F(?P<site>\d+)L(?P<l>\d+)A(?P<a>\d+)Z(?P<z>\d+)(?P<c>[C]\d{2})\.')
-
 possible_site_numbers = sorted(list(set([i * j for j in range(10,20) for i in range(j-5,j)])))
 
 
-def list_all_files_same_site(source_dir, fname):
-    matches = re.match(pattern, fname)
-    search_string = (r'^' +
-                     re.escape(matches.group('stem')) +
-                     r'_' + matches.group('well') +
-                     r'_T(?P<t>\d+)' +
-                     r'F' + matches.group('site') +
-                     r'L\d+A\d+Z(?P<z>\d+)(?P<c>[C]\d{2})\.')
-    logger.debug('finding files in %s, in well %s, site %s',
-                 source_dir,
-                 matches.group('well'),
-                 matches.group('site'))
-    files = [f for f in os.listdir(source_dir) if re.match(search_string, f)]
-    return files
-
-
 def parse_arguments():
     parser = argparse.ArgumentParser(
         prog='extend_wells_to_max_site_number',
@@ -44,6 +26,15 @@ def parse_arguments():
     parser.add_argument('empty_dir', help='path to directory containing empty images')
     parser.add_argument('target_dir',
                         help='path to directory where new links should be created')
+    parser.add_argument('--cached-index', action='store_true',
+                        help=('keep persistent indexes of the source and empty'
+                              ' directories and only list them again when'
+                              ' they have changed'))
+    parser.add_argument('--seed', type=int,
+                        help=('random seed for choosing empty sites (default:'
+                              ' a new one, a resumed run reuses the seed'
+                              ' recorded in the journal)'))
+    file_operations.add_plan_arguments(parser)
 
     return(parser.parse_args())
 
@@ -70,11 +61,22 @@ def main(args):
     logger.addHandler(fh)
 
 
+    # record of the links that were created, to resume or roll back
+    journal_path = os.path.join(args.target_dir,
+                                'extend-wells-to-max-site-number-journal.tsv')
+    if args.rollback:
+        sys.exit(1 if file_operations.rollback_journal(
+            journal_path, logger) else 0)
+
+    # list the source and empty directories once
+    index = open_index(args.source_dir, 'png', args.cached_index)
+    empty_index = open_index(args.empty_dir, 'png', args.cached_index)
+
     # get all names for channel 01
-    all_filenames_C01 = sorted([os.path.basename(full_path) for full_path in glob.glob(args.source_dir + '*C01.png')])
+    all_filenames_C01 = index.select(channel='C01')
 
     # get unique well and sites
-    well_site_names = [(m.group('well'), int(m.group('site'))) for f in all_filenames_C01 for m in [re.match(pattern,f)] if m]
+    well_site_names = [index.records[f].site_key for f in all_filenames_C01]
 
     # find number of sites per well
     unique_wells = sorted(list(set([i[0] for i in well_site_names])))
@@ -105,66 +107,49 @@ def main(args):
     # 1. use the first site as a template for new filenames
     # 2. randomly select a site from the empty directory and
     #    link the corresponding channels to that site
-    filenames_single_site = sorted(
-        list_all_files_same_site(
-            args.source_dir, all_filenames_C01[0]
-        )
-    )
+    filenames_single_site = index.files_same_site(all_filenames_C01[0])
     files_to_link = []
-    empty_files = [os.path.basename(full_path) for full_path in glob.glob(args.empty_dir + '*.png')]
+    empty_files = sorted(empty_index.records)
 
     logger.debug('selecting random sites from %s',args.empty_dir)
+    # the seed is kept in the journal, a resumed run makes the same choices
+    try:
+        seed = file_operations.journal_seed(journal_path, args.seed, logger)
+    except ValueError as err:
+        logger.error('%s', err)
+        sys.exit(str(err))
+    random.seed(seed)
     for well, site in well_site_names_to_add:
-        empty_site = re.match(pattern,random.choice(empty_files))
+        empty_site = empty_index.records[random.choice(empty_files)]
         for basefile in filenames_single_site:
-            new_site = re.match(pattern, basefile)
-            link_name = (
-                new_site.group('stem') +
-                '_' + well +
-                '_T' + new_site.group('t') +
-                'F' + str(site).zfill(3) +
-                'L' + new_site.group('l') +
-                'A' + new_site.group('a') +
-                'Z' + new_site.group('z') +
-                new_site.group('c') + '.png'
-            )
+            new_site = index.records[basefile]
+            link_name = new_site._replace(
+                well=well, site=str(site).zfill(3), ext='png').filename
 
             # add a couple of catches to account for differing dimensions between sites
-            if (int(new_site.group('z')) < 20) and (new_site.group('c') == 'C04'):
-                z_plane = new_site.group('z')
-            elif (int(new_site.group('z')) < 40) and (new_site.group('c') == 'C03'):
-                z_plane = new_site.group('z')
+            if (int(new_site.z) < 20) and (new_site.c == 'C04'):
+                z_plane = new_site.z
+            elif (int(new_site.z) < 40) and (new_site.c == 'C03'):
+                z_plane = new_site.z
             else:
                 z_plane = '01'
 
-            source_file = (
-                empty_site.group('stem') +
-                '_' + empty_site.group('well') +
-                '_T' + new_site.group('t') +
-                'F' + empty_site.group('site') +
-                'L' + new_site.group('l') +
-                'A' + new_site.group('a') +
-                'Z' + z_plane +
-                new_site.group('c') + '.png'
-            )
+            source_file = new_site._replace(
+                stem=empty_site.stem, well=empty_site.well,
+                site=empty_site.site, z=z_plane, ext='png').filename
             files_to_link.append((source_file, link_name))
 
-    for source, link in files_to_link:
-        logger.info(
-            'creating hard link %s to file %s',
-            os.path.join(args.target_dir,link),
-            os.path.join(args.empty_dir,source)
-        )
-        try:
-            os.link(os.path.join(args.empty_dir,source),
-                    os.path.join(args.target_dir,link))
-        except OSError:
-            logger.warning(
-                'could not link %s to %s',
-                os.path.join(args.target_dir,link),
-                os.path.join(args.empty_dir,source)
-            )
-            pass
+    # validate and create all links
+    operations = [
+        file_operations.link(os.path.join(args.empty_dir, source),
+                             os.path.join(args.target_dir, link))
+        for source, link in files_to_link
+    ]
+    n_failed = file_operations.run_plan(
+        operations, journal_path, args.dry_run, args.threads, args.strict,
+        logger, seed)
+    if n_failed:
+        sys.exit(1)
 
     return
 
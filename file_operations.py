@@ -0,0 +1,338 @@
+import os
+import sys
+import random
+import logging
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+LINK, RENAME = 'link', 'rename'
+
+# file operations spend most of their time waiting for the file server,
+# so many more threads than cores pay off on network storage
+DEFAULT_THREADS = 32
+
+# journal line that records the random seed of a run
+_SEED = '#seed'
+
+
+class Operation(namedtuple('Operation', 'op src dst')):
+    '''A hard link (LINK) or rename (RENAME) of src to dst.'''
+    __slots__ = ()
+
+
+def link(src, dst):
+    return Operation(LINK, src, dst)
+
+
+def rename(src, dst):
+    return Operation(RENAME, src, dst)
+
+
+class _Directories(object):
+    # listings and devices of the directories of a plan, each read once
+
+    def __init__(self):
+        self._names = {}
+        self._devices = {}
+
+    def names(self, dir_path):
+        if dir_path not in self._names:
+            try:
+                with os.scandir(dir_path or '.') as entries:
+                    self._names[dir_path] = set(e.name for e in entries)
+            except OSError:
+                self._names[dir_path] = None
+        return self._names[dir_path]
+
+    def exists(self, file_path):
+        dir_path, name = os.path.split(file_path)
+        names = self.names(dir_path)
+        return names is not None and name in names
+
+    def device(self, dir_path):
+        # device of dir_path, or of its closest existing parent
+        if dir_path not in self._devices:
+            try:
+                self._devices[dir_path] = os.stat(dir_path or '.').st_dev
+            except OSError:
+                parent = os.path.dirname(dir_path)
+                self._devices[dir_path] = (
+                    self.device(parent) if parent != dir_path else None)
+        return self._devices[dir_path]
+
+
+def _same_file(a, b):
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+
+def validate_plan(operations):
+    '''Checks a plan against the file system before anything is changed.
+
+    Returns (todo, skipped, problems). skipped are operations whose result
+    is already in place, e.g. from an interrupted run. problems are (operation, reason) for operations
+    that cannot succeed: missing sources, existing destinations, two
+    operations with the same destination, sources that another operation
+    creates or moves, and links or renames across file systems.
+    Directories are listed once each instead of stat-ing every file.
+    '''
+    dirs = _Directories()
+    destinations = {}
+    for operation in operations:
+        destinations.setdefault(operation.dst, []).append(operation)
+    moved = {}
+    for operation in operations:
+        if operation.op == RENAME:
+            moved[operation.src] = moved.get(operation.src, 0) + 1
+
+    todo = []
+    skipped = []
+    problems = []
+    for operation in operations:
+        op, src, dst = operation
+        if len(destinations[dst]) > 1:
+            problems.append((operation, 'destination used by {} operations'
+                             .format(len(destinations[dst]))))
+            continue
+        if (src in destinations or (op == LINK and src in moved) or
+                moved.get(src, 0) > 1):
+            problems.append((operation, 'source is changed by another'
+                             ' operation of the plan'))
+            continue
+        src_exists = dirs.exists(src)
+        dst_exists = dirs.exists(dst)
+        if dst_exists:
+            if ((op == LINK and _same_file(src, dst)) or
+                    (op == RENAME and not src_exists)):
+                # applied by an earlier run
+                skipped.append(operation)
+            else:
+                problems.append((operation, 'destination exists'))
+            continue
+        if not src_exists:
+            problems.append((operation, 'source does not exist'))
+            continue
+        # missing destination directories are created by execute_plan
+        if dirs.device(os.path.dirname(src)) != dirs.device(
+                os.path.dirname(dst)):
+            problems.append((operation, 'source and destination are on'
+                             ' different file systems'))
+            continue
+        todo.append(operation)
+    return todo, skipped, problems
+
+
+def read_journal(journal_path):
+    # operations recorded in a journal, in the order they were planned
+    operations = []
+    if not os.path.exists(journal_path):
+        return operations
+    with open(journal_path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 3 and fields[0] in (LINK, RENAME):
+                operations.append(Operation(*fields))
+    return operations
+
+
+def _apply(operation):
+    try:
+        if operation.op == LINK:
+            os.link(operation.src, operation.dst)
+        else:
+            os.rename(operation.src, operation.dst)
+    except OSError as err:
+        return operation, str(err)
+    return operation, None
+
+
+def _recorded_seed(journal_path):
+    # seed recorded in the journal at journal_path, or None
+    if not os.path.exists(journal_path):
+        return None
+    with open(journal_path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 2 and fields[0] == _SEED:
+                return int(fields[1])
+    return None
+
+
+def journal_seed(journal_path, seed=None, log=logger):
+    '''Random seed of the run that writes the journal at journal_path.
+
+    A resumed run takes the seed recorded in the journal, so that it
+    plans the same random choices as the interrupted run. Otherwise it
+    is seed, or a new random one if seed is None, which execute_plan
+    records when it opens the journal. Nothing is written here, so dry
+    runs leave the journal alone. Raises ValueError if seed differs from
+    the recorded one, or if the journal records operations but no seed.
+    '''
+    recorded = _recorded_seed(journal_path)
+    if recorded is not None:
+        if seed is not None and seed != recorded:
+            raise ValueError(
+                'journal {} was written with seed {}, not {}; roll it back'
+                ' to start over'.format(journal_path, recorded, seed))
+        log.info('resuming with seed %d from %s', recorded, journal_path)
+        return recorded
+    if read_journal(journal_path):
+        raise ValueError('journal {} records no seed, roll it back to start'
+                         ' over'.format(journal_path))
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32)
+    log.info('random seed %d', seed)
+    return seed
+
+
+def execute_plan(operations, journal_path=None, threads=DEFAULT_THREADS,
+                 log=logger, seed=None):
+    '''Applies validated operations with a pool of threads.
+
+    Missing destination directories are created first. All operations are
+    appended to the journal, one tab-separated line each, and synced to
+    disk before the first one is applied, so that rollback_journal can
+    undo whatever part of the run was applied, even if it is killed.
+    seed, the random seed of the plan from journal_seed, is recorded
+    first if the journal does not have it yet. Returns the failed operations as (operation, error).
+    '''
+    for dst_dir in sorted(set(os.path.dirname(o.dst) for o in operations)):
+        if dst_dir and not os.path.isdir(dst_dir):
+            log.info('creating directory %s', dst_dir)
+            os.makedirs(dst_dir)
+    if journal_path:
+        record_seed = seed is not None and _recorded_seed(journal_path) is None
+        with open(journal_path, 'a') as journal:
+            if record_seed:
+                journal.write('{}\t{}\n'.format(_SEED, seed))
+            for operation in operations:
+                journal.write('\t'.join(operation) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+    failed = []
+    pool = ThreadPool(threads)
+    try:
+        for i, (operation, error) in enumerate(
+                pool.imap_unordered(_apply, operations, chunksize=16), 1):
+            if error is not None:
+                log.warning('could not %s %s to %s: %s', operation.op,
+                            operation.src, operation.dst, error)
+                failed.append((operation, error))
+            else:
+                log.debug('%s %s to %s', operation.op, operation.src,
+                          operation.dst)
+            if i % 10000 == 0:
+                log.info('%d of %d operations done', i, len(operations))
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+def _applied(operation):
+    # True if the result of operation is in place, False if it is not,
+    # None if the files have been changed since
+    op, src, dst = operation
+    if not os.path.lexists(dst):
+        return False
+    if op == LINK:
+        return True if _same_file(src, dst) else None
+    return None if os.path.lexists(src) else True
+
+
+def rollback_journal(journal_path, log=logger):
+    # undoes the operations of a journal that were applied, in reverse
+    # order, and removes it. Planned operations that were never applied
+    # are skipped. Returns the number of operations that could not be
+    # undone
+    if not os.path.exists(journal_path):
+        log.warning('no journal %s to roll back', journal_path)
+        return 0
+    not_undone = []
+    seen = set()
+    for operation in reversed(read_journal(journal_path)):
+        if operation in seen:
+            continue
+        seen.add(operation)
+        op, src, dst = operation
+        applied = _applied(operation)
+        if applied is False:
+            continue
+        try:
+            if applied is None:
+                raise OSError('{} has been changed since'.format(dst))
+            if op == LINK:
+                os.unlink(dst)
+            else:
+                os.rename(dst, src)
+        except OSError as err:
+            log.warning('could not undo %s of %s to %s: %s', op, src, dst,
+                        err)
+            not_undone.append(operation)
+    if not_undone:
+        # keep what is left, so that the rollback can be repeated
+        with open(journal_path, 'w') as f:
+            for operation in reversed(not_undone):
+                f.write('\t'.join(operation) + '\n')
+    else:
+        os.remove(journal_path)
+    log.info('rolled back %s, %d operations could not be undone',
+             journal_path, len(not_undone))
+    return len(not_undone)
+
+
+def add_plan_arguments(parser):
+    # options of run_plan for the argument parser of a script
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='validate and print the planned operations without applying'
+             ' them')
+    parser.add_argument(
+        '--threads', type=int, default=DEFAULT_THREADS,
+        help='number of concurrent file operations')
+    parser.add_argument(
+        '--strict', action='store_true',
+        help='apply nothing if any operation is invalid, instead of'
+             ' skipping the invalid ones')
+    parser.add_argument(
+        '--rollback', action='store_true',
+        help='undo the operations recorded in the journal instead')
+
+
+def run_plan(operations, journal_path, dry_run=False,
+             threads=DEFAULT_THREADS, strict=False, log=logger, seed=None):
+    '''Validates and applies a plan.
+
+    Operations whose result is already in place are skipped, so an
+    interrupted run is resumed by running it again. The operations are
+    recorded in the journal at journal_path, after the random seed of
+    the plan if it has one. A dry run writes nothing. Returns the number of
+    operations that were invalid or failed.
+    '''
+    todo, skipped, problems = validate_plan(operations)
+    log.info('%d operations planned: %d to do, %d already done,'
+             ' %d invalid', len(operations), len(todo), len(skipped),
+             len(problems))
+    for operation, reason in problems:
+        log.warning('cannot %s %s to %s: %s', operation.op, operation.src,
+                    operation.dst, reason)
+    if dry_run:
+        for operation in todo:
+            sys.stdout.write('{}\t{}\t{}\n'.format(*operation))
+        for operation, reason in problems:
+            sys.stdout.write('invalid {}\t{}\t{}\t{}\n'.format(
+                operation.op, operation.src, operation.dst, reason))
+        return len(problems)
+    if problems and strict:
+        log.error('not applying the plan, %d operations are invalid',
+                  len(problems))
+        return len(problems)
+
+    failed = execute_plan(todo, journal_path, threads, log, seed)
+    log.info('%d operations applied, %d failed', len(todo) - len(failed),
+             len(failed))
+    return len(problems) + len(failed)
@@ -4,15 +4,22 @@ import time
 import warnings
 import logging
 import argparse
+import functools
 import numpy as np
 import multiprocessing as mp
 import imageio
 import os
-import re
-import glob
-from subprocess import check_call, CalledProcessError
 from MultiProcessingLog import MultiProcessingLog
-from jtmodules import smooth, threshold_manual, filter, label
+from plate_index_db import open_index
+from worker_profiling import (profiling_pool_args, merge_profiles,
+                              merge_allocations)
+from task_telemetry import (timed_task, phase, add_bytes, file_size,
+                            setup_telemetry, report_telemetry)
+from scipy import ndimage
+
+# jtmodules is only imported by the jtmodules engine, it is slow to
+# import in every worker
+ENGINES = ('native', 'jtmodules')
 
 
 warnings.filterwarnings('ignore')
@@ -20,26 +27,113 @@ logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 
-def segment_primary(dapi):
-    dapiSmooth = smooth.main(dapi,'gaussian',7)
+# parameters of the nuclei segmentation
+NUCLEI_SMOOTHING = 7
+NUCLEI_THRESHOLD = 107
+NUCLEI_MIN_AREA = 2000
+
+# pre-screen outcomes, see prescreen_site
+EMPTY, FULL, AMBIGUOUS = 'empty', 'full', 'ambiguous'
+
+# work arrays of the native segmentation, reused for every image of the
+# same shape that a worker segments
+_buffers = {}
+
+
+def _work_arrays(shape):
+    if shape not in _buffers:
+        _buffers.clear()
+        _buffers[shape] = (np.empty(shape, dtype=np.float64),
+                           np.empty(shape, dtype=bool),
+                           np.empty(shape, dtype=np.int32))
+    return _buffers[shape]
+
+
+def segment_primary_jtmodules(dapi):
+    from jtmodules import smooth, threshold_manual, filter, label
+    dapiSmooth = smooth.main(dapi,'gaussian',NUCLEI_SMOOTHING)
     nucleiMask = threshold_manual.main(
         image=dapiSmooth.smoothed_image,
-        threshold=107
+        threshold=NUCLEI_THRESHOLD
     )
     nucleiMaskFiltered = filter.main(
         mask=nucleiMask.mask,
         feature='area',
-        lower_threshold=2000,
+        lower_threshold=NUCLEI_MIN_AREA,
         upper_threshold=None,
         plot=False
     )
     nuclei = label.main(mask=nucleiMaskFiltered.filtered_mask)
-    return nuclei
+    return nuclei.label_image
+
+
+def large_objects(dapi):
+    # the smoothing, threshold and area filter of segment_primary. Returns
+    # the 4-connected components of the mask, which are only valid until
+    # the next call, and a boolean array of the labels that are kept
+    smoothed, mask, labels = _work_arrays(dapi.shape)
+    ndimage.gaussian_filter(dapi, NUCLEI_SMOOTHING, output=smoothed)
+    np.greater(smoothed, NUCLEI_THRESHOLD, out=mask)
+    ndimage.label(mask, output=labels)
+    keep = np.bincount(labels.ravel()) >= NUCLEI_MIN_AREA
+    keep[0] = False
+    return labels, keep
+
+
+def segment_primary_native(dapi):
+    labels, keep = large_objects(dapi)
+    # jtmodules labels the filtered mask with 8-connectivity
+    label_image, _ = ndimage.label(keep[labels],
+                                   structure=np.ones((3, 3), dtype=bool))
+    return label_image
 
 
-def contains_nucleus(dapi):
-    nuclei = segment_primary(dapi)
-    return True if np.max(nuclei.label_image) > 0 else False
+def segment_primary(dapi, engine='native'):
+    # label image of the nuclei in dapi
+    if engine == 'jtmodules':
+        return segment_primary_jtmodules(dapi)
+    return segment_primary_native(dapi)
+
+
+def contains_nucleus(dapi, engine='native'):
+    if engine == 'jtmodules':
+        return True if np.max(segment_primary(dapi, engine)) > 0 else False
+    # any object that survives the area filter is a nucleus, no need to
+    # label the filtered mask
+    labels, keep = large_objects(dapi)
+    return bool(keep.any())
+
+
+def bin_image(image, factor):
+    # mean over factor x factor blocks, dropping incomplete edge blocks
+    if factor <= 1:
+        return image.astype(np.float32)
+    height = image.shape[0] // factor * factor
+    width = image.shape[1] // factor * factor
+    blocks = image[:height, :width].reshape(
+        height // factor, factor, width // factor, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def prescreen_site(dapi, bin_factor=4, full_fraction=0.02,
+                   full_percentile=99.0, full_intensity=160):
+    # cheap first stage of the detector. A site is EMPTY only if no pixel
+    # is above the nuclei threshold: the Gaussian smoothing of the
+    # segmentation is a weighted mean, so it cannot lift any pixel above
+    # the brightest one, while a few bright pixels can be smoothed into
+    # an object of more than the minimum area. A site is FULL if a large
+    # fraction of a binned image is above the threshold and its high
+    # percentile is clearly brighter than the threshold. Everything in
+    # between is AMBIGUOUS and goes through the full segmentation
+    brightest = dapi.max()
+    if brightest <= NUCLEI_THRESHOLD:
+        return EMPTY, 0.0, brightest
+    binned = bin_image(dapi, bin_factor)
+    above = np.count_nonzero(binned > NUCLEI_THRESHOLD) / float(binned.size)
+    high = np.percentile(binned, full_percentile)
+    if above >= full_fraction and high >= full_intensity:
+        return FULL, above, high
+    return AMBIGUOUS, above, high
 
 
 def load_image(source_dir, fname):
@@ -52,47 +146,50 @@ def load_image(source_dir, fname):
     return image
 
 
-def list_all_files_same_site(source_dir, fname):
-    pattern = (r'(?P<stem>.+)_(?P<well>[A-Z]\d{2})_T(?P<t>\d+)' +
-               r'F(?P<site>\d+)L\d+A\d+Z(?P<z>\d+)(?P<c>[C]\d{2})\.')
-    matches = re.match(pattern, fname)
-    search_string = (r'^' +
-                     re.escape(matches.group('stem')) +
-                     r'_' + matches.group('well') +
-                     r'_T(?P<t>\d+)' +
-                     r'F' + matches.group('site') +
-                     r'L\d+A\d+Z(?P<z>\d+)(?P<c>[C]\d{2})\.')
-    logger.debug('finding files in %s, in well %s, site %s',
-                 source_dir,
-                 matches.group('well'),
-                 matches.group('site'))
-    files = [f for f in os.listdir(source_dir) if re.match(search_string, f)]
-    return files
-
-
-def check_site_and_move(source_dir, fname, target_dir, move_empty=False):
-    dapi = load_image(source_dir,fname)
-    if not contains_nucleus(dapi):
+@timed_task('find_empty_sites', item_arg=1)
+def check_site_and_move(source_dir, fname, target_dir, move_empty=False,
+                        site_files=(), prescreen=None, engine='native'):
+    # site_files are all files of the site of fname, which are moved if
+    # it is empty. prescreen holds the keyword arguments of
+    # prescreen_site, or is None to segment every site. Returns how the
+    # site was classified
+    with phase('read'):
+        dapi = load_image(source_dir,fname)
+    add_bytes(read=file_size(os.path.join(source_dir,fname)))
+    outcome = AMBIGUOUS
+    if prescreen is not None:
+        with phase('prescreen'):
+            outcome, above, high = prescreen_site(dapi, **prescreen)
+        logger.debug('image %s pre-screened as %s, %.4f of pixels above'
+                     ' threshold, high intensity %s', fname, outcome,
+                     above, high)
+    if outcome == AMBIGUOUS:
+        with phase('compute'):
+            empty = not contains_nucleus(dapi, engine)
+        outcome = 'segmented'
+    else:
+        empty = outcome == EMPTY
+    if empty:
         logger.info('image %s does not contain any nuclei',fname)
-        files = list_all_files_same_site(source_dir,fname)
         if move_empty:
-            for file in files:
-                try:
-                    source_path = os.path.join(source_dir,file)
-                    dest_path = os.path.join(target_dir,file)
-                    logger.info('moving %s to %s',file, target_dir)
-                    os.rename(source_path,dest_path)
-                except OSError:
-                    pass
+            with phase('write'):
+                for file in site_files:
+                    try:
+                        source_path = os.path.join(source_dir,file)
+                        dest_path = os.path.join(target_dir,file)
+                        logger.info('moving %s to %s',file, target_dir)
+                        os.rename(source_path,dest_path)
+                    except OSError:
+                        pass
         else:
-            print fname
+            print(fname)
     else:
-        logger.info('image %s contains > 0 nuclei')
-    return
+        logger.info('image %s contains > 0 nuclei',fname)
+    return outcome
 
 
-def check_site_and_move_star(args):
-    return check_site_and_move(*args)
+def check_site_and_move_star(args, prescreen=None, engine='native'):
+    return check_site_and_move(*args, prescreen=prescreen, engine=engine)
 
 
 def parse_arguments():
@@ -107,9 +204,51 @@ def parse_arguments():
         '-v', '--verbosity', action='count', default=0,
         help='increase logging verbosity'
     )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help=('profile the worker processes with cProfile and write the'
+              ' merged stats next to the log')
+    )
+    parser.add_argument(
+        '--profile-memory', action='store_true',
+        help=('profile the workers and also trace their memory'
+              ' allocations with tracemalloc')
+    )
     parser.add_argument('source_dir', help='path to source directory')
     parser.add_argument('target_dir', help='path to destination directory')
     parser.add_argument('--move', action='store_true', help='move sites identified as empty')
+    parser.add_argument(
+        '--cached-index', action='store_true',
+        help=('keep a persistent index of the source directory and only'
+              ' list it again when it has changed')
+    )
+    parser.add_argument(
+        '--engine', choices=ENGINES, default='native',
+        help=('segmentation implementation: built-in NumPy/SciPy or the'
+              ' original jtmodules pipeline')
+    )
+    parser.add_argument(
+        '--no-prescreen', action='store_true',
+        help='segment every site instead of pre-screening intensities'
+    )
+    parser.add_argument(
+        '--bin', type=int, default=4,
+        help='binning factor of the image used for pre-screening'
+    )
+    parser.add_argument(
+        '--full-fraction', type=float, default=0.02,
+        help=('sites with at least this fraction of binned pixels above'
+              ' the nuclei threshold are full without segmentation, if'
+              ' they also pass --full-intensity')
+    )
+    parser.add_argument(
+        '--full-percentile', type=float, default=99.0,
+        help='percentile of the binned image compared to --full-intensity'
+    )
+    parser.add_argument(
+        '--full-intensity', type=float, default=160,
+        help='minimum --full-percentile intensity of a full site'
+    )
 
     return(parser.parse_args())
 
@@ -118,36 +257,65 @@ def main(args):
 
     # setup logging
     formatter = logging.Formatter('%(asctime)s %(levelname)s | %(filename)s/%(funcName)s: %(message)s')
-    mp_log = MultiProcessingLog(
-        os.path.join(args.source_dir,
-                  'find-empty-sites-' +
-                  time.strftime('%Y%m%d-%H%M%S') +
-                  '.log'),
-        'w', 0, 0
-    )
+    log_stem = os.path.join(args.source_dir,
+                            'find-empty-sites-' +
+                            time.strftime('%Y%m%d-%H%M%S'))
+    mp_log = MultiProcessingLog(log_stem + '.log', 'w', 0, 0)
     mp_log.setFormatter(formatter)
     logger.addHandler(mp_log)
 
+    # per-image timings as JSON lines next to the log
+    telemetry_path = log_stem + '.jsonl'
+    telemetry_log = setup_telemetry(telemetry_path)
+
     if args.move and (not os.path.exists(args.target_dir)):
         os.makedirs(args.target_dir)
 
-    images = [os.path.basename(full_path) for full_path in glob.glob(args.source_dir + '*C01.tif')]
+    # list the plate once, each task gets the files of its own site.
+    # The index keeps every extension, so that all files of an empty
+    # site are moved, while only the TIFFs are checked for nuclei
+    index = open_index(args.source_dir, None, args.cached_index)
+    images = [image for image in index.select(channel='C01')
+              if index.records[image].ext == 'tif']
     logger.debug('found %d images in %s',len(images),args.source_dir)
     source_dirs = [args.source_dir for image in images]
     target_dirs = [args.target_dir for image in images]
     params = [args.move for image in images]
+    site_files = [index.files_same_site(image) for image in images]
+
+    function_args = zip(source_dirs,images,target_dirs,params,site_files)
+
+    # optionally profile the workers, where the actual work happens
+    profile_dir = None
+    if args.profile or args.profile_memory:
+        profile_dir = log_stem + '-profile'
 
-    function_args = zip(source_dirs,images,target_dirs,params)
+    prescreen = None
+    if not args.no_prescreen:
+        prescreen = {
+            'bin_factor': args.bin,
+            'full_fraction': args.full_fraction,
+            'full_percentile': args.full_percentile,
+            'full_intensity': args.full_intensity
+        }
 
     # use a multi-processing pool to get the work done
-    pool = mp.Pool()
-    pool.map(
-        check_site_and_move_star,
+    pool = mp.Pool(**profiling_pool_args(profile_dir, args.profile_memory))
+    outcomes = pool.map(
+        functools.partial(check_site_and_move_star, prescreen=prescreen,
+                          engine=args.engine),
         function_args
     )
     pool.close()
     pool.join()
+    logger.info('%d sites pre-screened as empty, %d as full, %d segmented',
+                outcomes.count(EMPTY), outcomes.count(FULL),
+                outcomes.count('segmented'))
 
+    if profile_dir is not None:
+        merge_profiles(profile_dir, log_stem + '.pstats')
+        merge_allocations(profile_dir, log_stem + '-allocations.txt')
+    report_telemetry(telemetry_log, telemetry_path)
     return
 
 
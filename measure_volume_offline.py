@@ -5,6 +5,7 @@ import cv2
 import numpy as np
 import tifffile as tiff
 import pandas as pd
+from tiff_memmap import imread_memmap
 from jtmodules import smooth, threshold_manual, fill, filter, label, register_objects, segment_secondary, generate_volume_image, measure_volume_image, invert, combine_masks
 from random import sample
 
@@ -150,7 +151,8 @@ if __name__ == "__main__":
             STACK_dir, well_name,
             fname_stub + input_channel + str(site) + '.stk'
         )
-        beads = tiff.imread(beads_path)
+        # memory-map the uncompressed STK stack instead of decoding it
+        beads = imread_memmap(beads_path)
 
         # convert beads to conventional x,y,z ordering and make contiguous
         beads3D = np.swapaxes(beads, 0, 1)
@@ -5,34 +5,15 @@ import warnings
 import logging
 import argparse
 import os
-import re
-import glob
+import sys
+import file_operations
 from MultiProcessingLog import MultiProcessingLog
+from plate_index_db import open_index
 
 warnings.filterwarnings('ignore')
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-pattern = (r'(?P<stem>.+)_(?P<well>[A-Z]\d{2})_T(?P<t>\d+)' +
-           r'F(?P<site>\d+)L(?P<l>\d+)A(?P<a>\d+)Z(?P<z>\d+)(?P<c>[C]\d{2})\.')
-
-
-def list_all_files_same_site(source_dir, fname):
-    matches = re.match(pattern, fname)
-    search_string = (r'^' +
-                     re.escape(matches.group('stem')) +
-                     r'_' + matches.group('well') +
-                     r'_T(?P<t>\d+)' +
-                     r'F' + matches.group('site') +
-                     r'L\d+A\d+Z(?P<z>\d+)(?P<c>[C]\d{2})\.')
-    logger.debug('finding files in %s, in well %s, site %s',
-                 source_dir,
-                 matches.group('well'),
-                 matches.group('site'))
-    files = [f for f in os.listdir(source_dir) if re.match(search_string, f)]
-    return files
-
-
 def parse_arguments():
     parser = argparse.ArgumentParser(
         prog='move_empty_sites',
@@ -46,28 +27,28 @@ def parse_arguments():
     )
     parser.add_argument('source_dir', help='path to source directory')
     parser.add_argument('target_dir', help='path to destination directory')
+    parser.add_argument(
+        '--cached-index', action='store_true',
+        help=('keep a persistent index of the source directory and only'
+              ' list it again when it has changed')
+    )
+    file_operations.add_plan_arguments(parser)
 
     return(parser.parse_args())
 
 
-def links_per_well(source_dir, filenames_C01):
+def links_per_well(index, filenames_C01):
 
     files_to_link = []
     new_site_number = 0
 
     for fname_C01 in filenames_C01:
         new_site_number += 1
-        old_names = sorted(list_all_files_same_site(source_dir, fname_C01))
+        old_names = index.files_same_site(fname_C01)
         for old_name in old_names:
-            matches = re.match(pattern, old_name)
-            new_name = (matches.group('stem') +
-                        '_' + matches.group('well') +
-                        '_T0001' +
-                        'F' + str(new_site_number).zfill(3) +
-                        'L' + matches.group('l') +
-                        'A' + matches.group('a') +
-                        'Z' + matches.group('z') +
-                        matches.group('c') + '.tif')
+            new_name = index.records[old_name]._replace(
+                t='0001', site=str(new_site_number).zfill(3),
+                ext='tif').filename
             files_to_link.append((old_name,new_name))
 
     return(files_to_link)
@@ -90,32 +71,37 @@ def main(args):
     mp_log.setFormatter(formatter)
     logger.addHandler(mp_log)
 
-    # get all names for channel 01
-    all_filenames_C01 = sorted([os.path.basename(full_path) for full_path in glob.glob(args.source_dir + '*C01.tif')])
+    # record of the links that were created, to resume or roll back
+    journal_path = os.path.join(args.target_dir,
+                                'modify-site-order-journal.tsv')
+    if args.rollback:
+        sys.exit(1 if file_operations.rollback_journal(journal_path) else 0)
 
-    # get unique wells
-    well_names = [m.group('well') for f in all_filenames_C01 for m in [re.match(pattern,f)] if m]
-    unique_well_names = sorted(list(set(well_names)))
+    # list the source directory once
+    index = open_index(args.source_dir, 'tif', args.cached_index)
 
     # generate a list of tuples containing files to be linked
     files_to_link = []
-    for well in unique_well_names:
+    for well in index.wells():
 
-        # split list by well_name
-        well_regex = re.compile('.*_' + well + '_')
-        fnames_C01 = filter(well_regex.match, all_filenames_C01)
+        # channel 01 images of this well
+        fnames_C01 = index.select(channel='C01', well=well)
 
         # generate list of links per well
         files_to_link.extend(
-            links_per_well(args.source_dir, fnames_C01)
+            links_per_well(index, fnames_C01)
         )
 
-    for fname_pair in files_to_link:
-        logger.info('creating %s as link to %s',
-                    os.path.join(args.target_dir,fname_pair[1]),
-                    os.path.join(args.source_dir,fname_pair[0]))
-        os.link(os.path.join(args.source_dir,fname_pair[0]),
-                os.path.join(args.target_dir,fname_pair[1]))
+    # validate and create all links
+    operations = [
+        file_operations.link(os.path.join(args.source_dir, old_name),
+                             os.path.join(args.target_dir, new_name))
+        for old_name, new_name in files_to_link
+    ]
+    n_failed = file_operations.run_plan(
+        operations, journal_path, args.dry_run, args.threads, args.strict)
+    if n_failed:
+        sys.exit(1)
 
     return
 
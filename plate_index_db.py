@@ -0,0 +1,220 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import time
+import logging
+import sqlite3
+import argparse
+from yokogawa_index import YokogawaIndex, parse_filename
+
+logger = logging.getLogger(__name__)
+
+DB_NAME = '.plate_index.sqlite'
+SCHEMA_VERSION = '1'
+
+# a directory mtime this close to the time of its listing may not show
+# files created in the same clock tick, so it is not trusted
+_MTIME_GRACE_S = 2.0
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    stem TEXT, well TEXT, t INTEGER, site INTEGER, z INTEGER, c TEXT,
+    ext TEXT, size INTEGER, mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_site ON files (well, site);
+CREATE INDEX IF NOT EXISTS files_plane ON files (c, z, well);
+'''
+
+
+class PlateIndexDB(object):
+    '''Persistent index of the CV7000 images in one plate directory.
+
+    The parsed name fields, size and mtime of every image are kept in an
+    SQLite database, by default a hidden file in the plate directory.
+    refresh() lists the directory only when its mtime has changed since
+    the last listing, and then only stats and parses names that are not
+    in the database yet, so opening an unchanged plate needs a single
+    stat. Files that are rewritten in place under the same name do not
+    change the directory mtime and keep their old size and mtime.
+    '''
+
+    def __init__(self, source_dir, db_path=None):
+        self.source_dir = source_dir
+        self.db_path = db_path or os.path.join(source_dir, DB_NAME)
+        self.conn = sqlite3.connect(self.db_path)
+        # no journal file next to the database, it would change the
+        # mtime of the plate directory on every write
+        self.conn.execute('PRAGMA journal_mode=MEMORY')
+        self.conn.executescript(_SCHEMA)
+        if self._meta('version') != SCHEMA_VERSION:
+            with self.conn:
+                self.conn.execute('DELETE FROM files')
+                self.conn.execute('DELETE FROM meta')
+                self._set_meta('version', SCHEMA_VERSION)
+
+    def _meta(self, key):
+        row = self.conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                          (key, value))
+
+    def refresh(self, force=False):
+        # bring the database up to date with the directory. Returns the
+        # number of files that were added and removed
+        dir_mtime = repr(os.stat(self.source_dir).st_mtime)
+        if not force and self._meta('dir_mtime') == dir_mtime:
+            return 0, 0
+
+        listed_at = time.time()
+        known = set(row[0] for row in self.conn.execute(
+            'SELECT name FROM files'))
+        current = set()
+        added = []
+        with os.scandir(self.source_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                rec = parse_filename(entry.name)
+                if rec is None:
+                    continue
+                current.add(entry.name)
+                if entry.name in known:
+                    continue
+                st = entry.stat()
+                added.append((entry.name, rec.stem, rec.well, int(rec.t),
+                              int(rec.site), int(rec.z), rec.c, rec.ext,
+                              st.st_size, st.st_mtime))
+        removed = known - current
+
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO files VALUES'
+                ' (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', added)
+            self.conn.executemany('DELETE FROM files WHERE name = ?',
+                                  ((name,) for name in removed))
+            # the mtime after writing, creating the database changes it
+            st = os.stat(self.source_dir)
+            if listed_at - st.st_mtime < _MTIME_GRACE_S:
+                self._set_meta('dir_mtime', '')
+            else:
+                self._set_meta('dir_mtime', repr(st.st_mtime))
+        logger.debug('plate index of %s: %d files added, %d removed',
+                     self.source_dir, len(added), len(removed))
+        return len(added), len(removed)
+
+    def select(self, well=None, site=None, channel=None, z=None, t=None,
+               extension=None):
+        # sorted names of the files that match all given fields
+        conditions = []
+        values = []
+        for column, value in (('well', well), ('site', site),
+                              ('c', channel), ('z', z), ('t', t),
+                              ('ext', extension)):
+            if value is not None:
+                conditions.append(column + ' = ?')
+                values.append(value)
+        query = 'SELECT name FROM files'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return [row[0] for row in
+                self.conn.execute(query + ' ORDER BY name', values)]
+
+    def channels(self):
+        return [row[0] for row in self.conn.execute(
+            'SELECT DISTINCT c FROM files ORDER BY c')]
+
+    def incomplete_sites(self, n_channels=None):
+        # (well, site, channels found) of the sites with fewer channels
+        # than n_channels, by default the number of channels on the plate
+        if n_channels is None:
+            n_channels = len(self.channels())
+        return self.conn.execute(
+            'SELECT well, site, COUNT(DISTINCT c) AS n FROM files'
+            ' GROUP BY well, site HAVING n < ? ORDER BY well, site',
+            (n_channels,)).fetchall()
+
+    def stat(self, name):
+        # (size, mtime) of name when it was indexed, or None
+        return self.conn.execute(
+            'SELECT size, mtime FROM files WHERE name = ?',
+            (name,)).fetchone()
+
+    def index(self, extension=None):
+        # a YokogawaIndex of the cached names
+        return YokogawaIndex(self.source_dir, extension, names=self.select())
+
+    def close(self):
+        self.conn.close()
+
+
+def open_index(source_dir, extension=None, cached=False):
+    '''YokogawaIndex of source_dir, from its PlateIndexDB if cached.
+
+    The cached index falls back to listing the directory if the database
+    cannot be written, e.g. on a read-only plate.
+    '''
+    if not cached:
+        return YokogawaIndex(source_dir, extension)
+    try:
+        db = PlateIndexDB(source_dir)
+        try:
+            db.refresh()
+            return db.index(extension)
+        finally:
+            db.close()
+    except sqlite3.Error as err:
+        logger.warning('cannot use a plate index in %s: %s', source_dir, err)
+        return YokogawaIndex(source_dir, extension)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog='plate_index_db',
+        description=('Updates the cached index of the CV7000 images in a'
+                     ' plate directory and lists the files that match the'
+                     ' given fields, or the sites with missing channels.')
+    )
+    parser.add_argument('source_dir', help='path to plate directory')
+    parser.add_argument('--well', help='e.g. B03')
+    parser.add_argument('--site', type=int)
+    parser.add_argument('--channel', help='e.g. C01')
+    parser.add_argument('--z', type=int)
+    parser.add_argument('--t', type=int)
+    parser.add_argument('--incomplete', action='store_true',
+                        help='list the sites with fewer channels than'
+                        ' --n-channels')
+    parser.add_argument('--n-channels', type=int,
+                        help='expected channels per site (default: all'
+                        ' channels on the plate)')
+    parser.add_argument('--force', action='store_true',
+                        help='list the directory even if it is unchanged')
+
+    return(parser.parse_args())
+
+
+def main(args):
+
+    db = PlateIndexDB(args.source_dir)
+    start = time.time()
+    added, removed = db.refresh(args.force)
+    sys.stderr.write('refreshed in {:.3f} s, {} files added, {} removed\n'
+                     .format(time.time() - start, added, removed))
+    if args.incomplete:
+        for well, site, n in db.incomplete_sites(args.n_channels):
+            print('{}\tF{}\t{} channels'.format(well, str(site).zfill(3), n))
+    else:
+        for name in db.select(args.well, args.site, args.channel, args.z,
+                              args.t):
+            print(name)
+    db.close()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
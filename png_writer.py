@@ -0,0 +1,132 @@
+import os
+import zlib
+import struct
+import numpy as np
+import tifffile
+
+PNG_FILTERS = ('none', 'sub', 'up', 'average', 'paeth', 'adaptive')
+
+_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_FILTER_TYPES = {'none': 0, 'sub': 1, 'up': 2, 'average': 3, 'paeth': 4}
+
+
+def _chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def _filter_rows(raw, png_filter, bpp):
+    # raw holds the bytes of one image row per line. All PNG filters
+    # predict from the unfiltered bytes, so every row can be filtered at
+    # once. Arithmetic wraps modulo 256 as required by the specification
+    left = np.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+    up = np.zeros_like(raw)
+    up[1:] = raw[:-1]
+
+    if png_filter == 'sub':
+        return raw - left
+    if png_filter == 'up':
+        return raw - up
+    if png_filter == 'average':
+        return raw - ((left.astype(np.uint16) + up) >> 1).astype(np.uint8)
+
+    upper_left = np.zeros_like(raw)
+    upper_left[1:, bpp:] = raw[:-1, :-bpp]
+    a = left.astype(np.int16)
+    b = up.astype(np.int16)
+    c = upper_left.astype(np.int16)
+    p = a + b - c
+    pa = np.abs(p - a)
+    pb = np.abs(p - b)
+    pc = np.abs(p - c)
+    predictor = np.where((pa <= pb) & (pa <= pc), left,
+                         np.where(pb <= pc, up, upper_left))
+    return raw - predictor
+
+
+def encode_png(image, level=6, png_filter='up'):
+    '''Encodes a 2D uint8 or uint16 array as a grayscale PNG.
+
+    level is the zlib compression level (0-9) and png_filter one of
+    PNG_FILTERS; 'adaptive' picks the filter with the smallest sum of
+    absolute differences per row, as libpng does by default.
+    '''
+    if png_filter not in PNG_FILTERS:
+        raise ValueError('unknown PNG filter {}, choose from {}'.format(
+            png_filter, ', '.join(PNG_FILTERS)))
+    image = np.asarray(image)
+    if image.ndim != 2 or image.dtype not in (np.uint8, np.uint16):
+        raise ValueError('can only encode 2D uint8 or uint16 images,'
+                         ' got {} {}'.format(image.shape, image.dtype))
+
+    height, width = image.shape
+    bit_depth = image.dtype.itemsize * 8
+    bpp = image.dtype.itemsize
+    # PNG stores 16-bit samples big-endian
+    raw = np.ascontiguousarray(image, dtype=image.dtype.newbyteorder('>'))
+    raw = raw.view(np.uint8).reshape(height, width * bpp)
+
+    rows = np.empty((height, width * bpp + 1), dtype=np.uint8)
+    if png_filter == 'adaptive':
+        candidates = [raw] + [_filter_rows(raw, f, bpp)
+                              for f in ('sub', 'up', 'average', 'paeth')]
+        costs = np.stack([
+            np.abs(f.view(np.int8).astype(np.int32)).sum(axis=1)
+            for f in candidates])
+        best = np.argmin(costs, axis=0)
+        rows[:, 0] = best
+        for filter_type, filtered in enumerate(candidates):
+            selected = best == filter_type
+            rows[selected, 1:] = filtered[selected]
+    else:
+        rows[:, 0] = _FILTER_TYPES[png_filter]
+        rows[:, 1:] = raw if png_filter == 'none' else _filter_rows(
+            raw, png_filter, bpp)
+
+    header = struct.pack('>IIBBBBB', width, height, bit_depth, 0, 0, 0, 0)
+    return b''.join([
+        _SIGNATURE,
+        _chunk(b'IHDR', header),
+        _chunk(b'IDAT', zlib.compress(rows.tobytes(), level)),
+        _chunk(b'IEND', b'')
+    ])
+
+
+def write_png(png_path, data):
+    # written next to the target and renamed into place, so that an
+    # interrupted conversion never leaves a truncated PNG behind
+    out_dir, out_name = os.path.split(png_path)
+    tmp_path = os.path.join(
+        out_dir, '.tmp-{}-{}'.format(os.getpid(), out_name))
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, png_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_gray_tiff(tiff_path):
+    '''Reads a single-plane grayscale TIFF as uint16, or returns None.
+
+    8-bit samples are scaled by 257, as ImageMagick does for
+    -depth 16, so the result matches `mogrify -depth 16 -colorspace gray`.
+    Anything else (colour, palette, inverted, multi-page, signed, float or
+    odd bit depths) returns None and is left to ImageMagick.
+    '''
+    with tifffile.TiffFile(tiff_path) as tif:
+        series = tif.series[0]
+        page = tif.pages[0]
+        if (len(series.pages) != 1 or len(series.shape) != 2 or
+                page.samplesperpixel != 1 or
+                page.photometric != tifffile.PHOTOMETRIC.MINISBLACK or
+                page.bitspersample not in (8, 16) or
+                series.dtype not in (np.uint8, np.uint16)):
+            return None
+        image = series.asarray()
+    if image.dtype == np.uint8:
+        image = image.astype(np.uint16) * 257
+    return image
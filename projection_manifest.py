@@ -0,0 +1,70 @@
+import os
+import json
+import time
+
+
+def input_signature(image_paths):
+    # (path, size, mtime) of every input, or None if any input is missing
+    signature = []
+    for image_path in image_paths:
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            return None
+        signature.append([image_path, st.st_size, st.st_mtime])
+    return signature
+
+
+class ProjectionManifest(object):
+    '''Record of the sites that have been projected successfully.
+
+    Each entry is keyed by well, site and input channel and stores the
+    size and mtime of every input plane, the projection statistics and
+    the output paths. A site only counts as complete while its inputs are
+    unchanged and all of its outputs still exist, so reruns skip finished
+    work and redo anything that changed. The manifest is written to a
+    temporary file and renamed into place, so it is never left truncated.
+    '''
+
+    def __init__(self, manifest_path, flush_interval=30):
+        self.manifest_path = manifest_path
+        self.flush_interval = flush_interval
+        self._last_flush = time.time()
+        self._dirty = False
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def is_complete(self, key, signature, statistics, output_paths):
+        entry = self.entries.get(key)
+        if entry is None or signature is None:
+            return False
+        return (entry['inputs'] == signature and
+                entry['statistics'] == list(statistics) and
+                entry['outputs'] == list(output_paths) and
+                all(os.path.exists(p) for p in output_paths))
+
+    def record(self, key, signature, statistics, output_paths):
+        self.entries[key] = {
+            'inputs': signature,
+            'statistics': list(statistics),
+            'outputs': list(output_paths),
+            'completed': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        self._dirty = True
+        if time.time() - self._last_flush > self.flush_interval:
+            self.save()
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_path = self.manifest_path + '.tmp-{}'.format(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.manifest_path)
+        self._dirty = False
+        self._last_flush = time.time()
@@ -0,0 +1,147 @@
+import logging
+import threading
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from zprojection import ZProjector, read_plane, save_output
+from task_telemetry import TaskTimer, phase, add_bytes, file_size
+
+logger = logging.getLogger(__name__)
+
+
+def read_plane_timed(image_path):
+    # read one plane eagerly, as a telemetry record of its own
+    with TaskTimer('read_plane', image_path):
+        with phase('read'):
+            plane = read_plane(image_path, False)
+        add_bytes(read=plane.nbytes)
+    return plane
+
+
+class ProjectionPipeline(object):
+    '''Overlaps reading, reducing and writing of z-projections.
+
+    A small pool of reader threads prefetches the z-planes of the next
+    `prefetch_sites` sites while the calling thread reduces the current
+    one, and finished projections are written by a background writer
+    thread. Both the prefetch window and the write queue are bounded, so
+    at most (prefetch_sites + 1) stacks and `write_queue_depth` sets of
+    projections are held in memory at any time.
+
+    Telemetry has a read_plane record per plane, a project_site record
+    per site with the time the reduction waited for planes (read_wait)
+    and for the writer (write_wait), and a write_site record per site.
+    '''
+
+    def __init__(self, statistics=('max', 'sum'), sum_dtype=np.uint16,
+                 n_readers=4, prefetch_sites=2, write_queue_depth=4,
+                 focus_metric='laplacian', edf_window=15):
+        self.statistics = tuple(statistics)
+        self.sum_dtype = sum_dtype
+        self.focus_metric = focus_metric
+        self.edf_window = edf_window
+        self.n_readers = n_readers
+        self.prefetch_sites = prefetch_sites
+        self.write_queue_depth = write_queue_depth
+        self._write_queue = None
+        self._results = []
+
+    def _write_loop(self):
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            label, projections, output_paths = item
+            error = None
+            with TaskTimer('write_site', label) as timer:
+                for statistic, out_path in output_paths:
+                    try:
+                        logger.info('%s, saving %s: %s', label, statistic,
+                                    out_path)
+                        with phase('write'):
+                            save_output(out_path, statistic,
+                                        projections[statistic])
+                        add_bytes(written=file_size(out_path))
+                    except Exception as err:
+                        logger.error('%s, failed to save %s: %s',
+                                     label, out_path, err)
+                        error = error or str(err)
+                timer.error = error
+            self._results.append((label, error))
+
+    def run(self, sites):
+        # sites is an iterable of (label, image_paths, output_paths)
+        # where output_paths is a list of (statistic, path) pairs,
+        # optionally including a ('focus_scores', path) sidecar.
+        # Returns a (label, error) pair for every site, error being None
+        # for sites whose projections were all written
+        self._write_queue = queue.Queue(maxsize=self.write_queue_depth)
+        self._results = []
+        writer = threading.Thread(target=self._write_loop)
+        writer.start()
+
+        sites = iter(sites)
+        pending = deque()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.n_readers) as readers:
+
+                def submit_next_site():
+                    for label, image_paths, output_paths in sites:
+                        # planes are read eagerly rather than memory-mapped
+                        # so the I/O happens in the reader threads
+                        futures = deque(
+                            readers.submit(read_plane_timed, p)
+                            for p in image_paths)
+                        pending.append((label, futures, output_paths))
+                        return True
+                    return False
+
+                for _ in range(self.prefetch_sites + 1):
+                    if not submit_next_site():
+                        break
+
+                while pending:
+                    label, futures, output_paths = pending.popleft()
+
+                    logger.info('%s, reducing %d planes', label, len(futures))
+                    with TaskTimer('project_site', label) as timer:
+                        try:
+                            projector = ZProjector(
+                                self.statistics, self.sum_dtype,
+                                self.focus_metric, self.edf_window)
+                            while futures:
+                                # drop each plane as soon as it has been
+                                # added
+                                with phase('read_wait'):
+                                    plane = futures.popleft().result()
+                                with phase('compute'):
+                                    projector.update(plane)
+                                plane = None
+                            with phase('compute'):
+                                projections = projector.result()
+                        except Exception as err:
+                            logger.error('%s, projection failed: %s',
+                                         label, err)
+                            for future in futures:
+                                future.cancel()
+                            timer.error = str(err)
+                            self._results.append((label, str(err)))
+                            continue
+                        finally:
+                            # only once the planes of this site are gone,
+                            # so that the current and the prefetched sites
+                            # stay within prefetch_sites + 1 stacks
+                            submit_next_site()
+
+                        # blocks when the writer falls behind, which caps
+                        # the number of finished projections held in memory
+                        with phase('write_wait'):
+                            self._write_queue.put(
+                                (label, projections, output_paths))
+        finally:
+            self._write_queue.put(None)
+            writer.join()
+
+        return self._results
@@ -1,7 +1,10 @@
 import argparse
+import logging
 import os
 import re
+import sys
 import glob
+import file_operations
 
 pattern = (r'(?P<stem>.+)_(?P<well>[A-Z]\d{2})_T(?P<t>\d+)' +
            r'F(?P<site>\d+)L(?P<l>\d+)A(?P<a>\d+)Z(?P<z>\d+)(?P<c>[C]\d{2})\.')
@@ -15,22 +18,39 @@ def parse_arguments():
         description=('replaces T*** with T0001 in filename')
     )
     parser.add_argument('source_dir', help='path to source directory')
+    file_operations.add_plan_arguments(parser)
 
     return(parser.parse_args())
 
 
 def main(args):
 
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    # record of the renames, to resume or roll back
+    journal_path = os.path.join(args.source_dir,
+                                'remove-tpoint-journal.tsv')
+    if args.rollback:
+        sys.exit(1 if file_operations.rollback_journal(journal_path) else 0)
+
     # get all image filenames
     filenames = [os.path.basename(full_path) for full_path in glob.glob(args.source_dir + '*.png')]
 
     regex = re.compile(pattern)
+    operations = []
     for filename in filenames:
         new_name = re.sub(regex,replacement,filename)
-        os.rename(
-            os.path.join(args.source_dir,filename),
-            os.path.join(args.source_dir,new_name)
-        )
+        if new_name != filename:
+            operations.append(file_operations.rename(
+                os.path.join(args.source_dir,filename),
+                os.path.join(args.source_dir,new_name)
+            ))
+
+    n_failed = file_operations.run_plan(
+        operations, journal_path, args.dry_run, args.threads, args.strict)
+    if n_failed:
+        sys.exit(1)
 
     return
 
@@ -0,0 +1,273 @@
+import queue
+import logging
+import multiprocessing as mp
+from collections import deque
+from multiprocessing import shared_memory
+import numpy as np
+import tifffile
+from zprojection import ZProjector, save_output
+from task_telemetry import TaskTimer, phase, add_bytes, file_size
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks that the reader and reducer processes are alive
+_POLL_S = 1.0
+
+# sites queued at each reducer, so that it never waits for the next one
+_SITES_PER_REDUCER = 2
+
+
+class SharedPlanePool(object):
+    '''Preallocated plane-sized slots in a single shared memory block.
+
+    Reader processes decode TIFFs straight into a slot and reducer
+    processes work on the same memory, so planes are never pickled or
+    copied between processes. Slots are not tracked here: whoever hands
+    out a slot index is responsible for recycling it once it has been
+    consumed.
+    '''
+
+    def __init__(self, n_slots, shape, dtype, name=None):
+        self.n_slots = n_slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        if name is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=max(1, n_slots * slot_bytes))
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self._slots = np.ndarray(
+            (n_slots,) + self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def __reduce__(self):
+        # child processes attach to the existing block by name
+        return (SharedPlanePool,
+                (self.n_slots, self.shape, self.dtype.str, self._shm.name))
+
+    def slot(self, index):
+        return self._slots[index]
+
+    def close(self):
+        self._slots = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _read_planes(planes, requests, replies):
+    # reader process: decode requested planes directly into their slot
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        reducer_index, z, slot, image_path = request
+        with TaskTimer('read_plane', image_path) as timer:
+            try:
+                with phase('read'):
+                    tifffile.imread(image_path, out=planes.slot(slot))
+                add_bytes(read=planes.slot(slot).nbytes)
+                error = None
+            except Exception as err:
+                error = '{}: {}'.format(image_path, err)
+            timer.error = error
+        replies[reducer_index].put((z, slot, error))
+
+
+def _reduce_sites(planes, reducer_index, slots, sites, requests, replies,
+                  results, statistics, sum_dtype, focus_metric, edf_window):
+    # reducer process: owns a fixed set of slots and keeps them all busy
+    # with read requests for the current site, reducing planes in z order.
+    # Each site is a telemetry record, with the time spent waiting for
+    # the readers as read_wait
+    free_slots = deque(slots)
+    while True:
+        site = sites.get()
+        if site is None:
+            break
+        with TaskTimer('project_site', site[0]) as timer:
+            timer.error = _reduce_site(
+                planes, reducer_index, free_slots, site, requests, replies,
+                statistics, sum_dtype, focus_metric, edf_window)
+        results.put((reducer_index, site[0], timer.error))
+
+
+def _reduce_site(planes, reducer_index, free_slots, site, requests, replies,
+                 statistics, sum_dtype, focus_metric, edf_window):
+    # project one site with the reducer's free slots. Returns the error,
+    # or None if all projections were written
+    label, image_paths, output_paths = site
+    projector = ZProjector(statistics, sum_dtype, focus_metric, edf_window)
+    ready = {}
+    n_requested = 0
+    n_received = 0
+    n_reduced = 0
+    error = None
+
+    while n_received < n_requested or (
+            error is None and n_reduced < len(image_paths)):
+        while (error is None and free_slots and
+               n_requested < len(image_paths)):
+            requests.put((reducer_index, n_requested,
+                          free_slots.popleft(), image_paths[n_requested]))
+            n_requested += 1
+
+        with phase('read_wait'):
+            z, slot, read_error = replies.get()
+        n_received += 1
+        if read_error is not None:
+            error = error or read_error
+        if error is not None:
+            free_slots.append(slot)
+            continue
+
+        ready[z] = slot
+        while n_reduced in ready:
+            slot = ready.pop(n_reduced)
+            with phase('compute'):
+                projector.update(planes.slot(slot))
+            free_slots.append(slot)
+            n_reduced += 1
+
+    # slots left over from an aborted site go back to the free list
+    free_slots.extend(ready.values())
+
+    if error is None:
+        try:
+            with phase('compute'):
+                projections = projector.result()
+            for statistic, out_path in output_paths:
+                logger.info('%s, saving %s: %s', label, statistic, out_path)
+                with phase('write'):
+                    save_output(out_path, statistic, projections[statistic])
+                add_bytes(written=file_size(out_path))
+        except Exception as err:
+            error = str(err)
+    return error
+
+
+def _plane_format(sites):
+    # (shape, dtype) of the planes, from the first plane of the first
+    # site that can be read. Unreadable sites are left to fail in the
+    # readers like any other read error
+    for label, image_paths, output_paths in sites:
+        if not image_paths:
+            continue
+        try:
+            with tifffile.TiffFile(image_paths[0]) as tif:
+                page = tif.pages[0]
+                return page.shape, page.dtype
+        except Exception as err:
+            logger.warning('%s, cannot read the plane format from %s: %s',
+                           label, image_paths[0], err)
+    raise ValueError('cannot read the plane format of any of {} sites'
+                     .format(len(sites)))
+
+
+def project_sites_shared_memory(sites, statistics=('max', 'sum'),
+                                sum_dtype=np.uint16, n_readers=4,
+                                n_reducers=None, slots_per_reducer=4,
+                                focus_metric='laplacian', edf_window=15):
+    # sites is a list of (label, image_paths, output_paths) where
+    # output_paths is a list of (statistic, path) pairs, optionally
+    # including a ('focus_scores', path) sidecar. Readers and
+    # reducers are separate processes and can be scaled independently.
+    # Returns a (label, error) pair for every site, error being None for
+    # sites whose projections were all written. The sites of a reducer
+    # that dies fail, and so do all remaining sites if a reader dies,
+    # since the plane it was reading never arrives
+    if not sites:
+        return []
+    if n_reducers is None:
+        n_reducers = mp.cpu_count()
+
+    shape, dtype = _plane_format(sites)
+    planes = SharedPlanePool(n_reducers * slots_per_reducer, shape, dtype)
+    requests = mp.Queue()
+    replies = [mp.Queue() for _ in range(n_reducers)]
+    site_queues = [mp.Queue() for _ in range(n_reducers)]
+    results = mp.Queue()
+
+    readers = [
+        mp.Process(target=_read_planes, args=(planes, requests, replies))
+        for _ in range(n_readers)
+    ]
+    reducers = [
+        mp.Process(
+            target=_reduce_sites,
+            args=(planes, i,
+                  range(i * slots_per_reducer, (i + 1) * slots_per_reducer),
+                  site_queues[i], requests, replies[i], results,
+                  statistics, sum_dtype, focus_metric, edf_window))
+        for i in range(n_reducers)
+    ]
+
+    site_results = []
+    pending = deque(sites)
+    # labels of the sites handed to each reducer, in the order it
+    # projects them
+    assigned = [deque() for _ in reducers]
+
+    def finish(label, error):
+        if error is not None:
+            logger.error('%s, projection failed: %s', label, error)
+        site_results.append((label, error))
+
+    def assign(i):
+        while (pending and len(assigned[i]) < _SITES_PER_REDUCER and
+               reducers[i].is_alive()):
+            site = pending.popleft()
+            assigned[i].append(site[0])
+            site_queues[i].put(site)
+
+    try:
+        for process in readers + reducers:
+            process.daemon = True
+            process.start()
+        for i in range(n_reducers):
+            assign(i)
+        while pending or any(assigned):
+            try:
+                i, label, error = results.get(timeout=_POLL_S)
+            except queue.Empty:
+                for i, process in enumerate(reducers):
+                    if assigned[i] and not process.is_alive():
+                        error = 'reducer process exited with code {}'.format(
+                            process.exitcode)
+                        while assigned[i]:
+                            finish(assigned[i].popleft(), error)
+                dead_readers = [p for p in readers if not p.is_alive()]
+                if dead_readers or not any(p.is_alive() for p in reducers):
+                    if dead_readers:
+                        error = 'reader process exited with code {}'.format(
+                            dead_readers[0].exitcode)
+                    else:
+                        error = 'all reducer processes exited'
+                    for labels in assigned:
+                        while labels:
+                            finish(labels.popleft(), error)
+                    while pending:
+                        finish(pending.popleft()[0], error)
+                    break
+                for i in range(n_reducers):
+                    assign(i)
+                continue
+            if assigned[i] and assigned[i][0] == label:
+                assigned[i].popleft()
+                finish(label, error)
+            assign(i)
+        for site_queue in site_queues:
+            site_queue.put(None)
+        for _ in readers:
+            requests.put(None)
+        for process in readers + reducers:
+            process.join(_POLL_S)
+    finally:
+        for process in readers + reducers:
+            if process.is_alive():
+                process.terminate()
+        planes.close()
+
+    return site_results
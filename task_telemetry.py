@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from MultiProcessingLog import MultiProcessingLog
+
+# per-task records go to their own logger so that they end up as plain
+# JSON lines in a separate file rather than in the text log
+telemetry_logger = logging.getLogger('telemetry')
+telemetry_logger.propagate = False
+
+PHASES = ('read', 'compute', 'write', 'subprocess')
+
+# workers inherit the run id through the environment, so records of
+# earlier runs appended to the same file can be told apart
+_RUN_ENV = 'IMAGEPREPROCESSING_TELEMETRY_RUN'
+
+_current = threading.local()
+
+# functions called without arguments at the end of every phase, while
+# the buffers of the phase are still alive, e.g. by worker_profiling to
+# snapshot the allocations of a task
+phase_end_hooks = []
+
+
+class TaskTimer(object):
+    '''Wall time per phase, bytes read and written for a single task.
+
+    Used as a context manager around one unit of work, e.g. one image or
+    one site. When the block exits, one JSON record with the phase times,
+    byte counts, worker PID and error (if any) is sent to the telemetry
+    logger. Exceptions are recorded but not suppressed; tasks that handle
+    their own errors can set the error attribute instead.
+    '''
+
+    def __init__(self, task, item):
+        self.task = task
+        self.item = item
+        self.phases = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.error = None
+        self._nested = []
+
+    def __enter__(self):
+        self._parent = getattr(_current, 'timer', None)
+        _current.timer = self
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        wall = time.time() - self._start
+        _current.timer = self._parent
+        record = {
+            'run': os.environ.get(_RUN_ENV),
+            'task': self.task,
+            'item': self.item,
+            'pid': os.getpid(),
+            'start': self._start,
+            'wall_s': wall,
+            'phases': self.phases,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'error': self.error if exc_type is None else '{}: {}'.format(
+                exc_type.__name__, exc_value)
+        }
+        telemetry_logger.info('%s', json.dumps(record))
+        return False
+
+    @contextmanager
+    def phase(self, name):
+        # time spent in a nested phase, e.g. reads interleaved with a
+        # reduction, is only counted in the inner phase
+        start = time.time()
+        self._nested.append(0.0)
+        try:
+            yield self
+        finally:
+            elapsed = time.time() - start
+            self.phases[name] = (
+                self.phases.get(name, 0.0) + elapsed - self._nested.pop())
+            if self._nested:
+                self._nested[-1] += elapsed
+            for hook in phase_end_hooks:
+                hook()
+
+    def add_bytes(self, read=0, written=0):
+        self.bytes_read += read
+        self.bytes_written += written
+
+
+def current_timer():
+    return getattr(_current, 'timer', None)
+
+
+@contextmanager
+def phase(name):
+    # time a phase of the task running in this thread, if there is one
+    timer = current_timer()
+    if timer is None:
+        yield None
+        return
+    with timer.phase(name):
+        yield timer
+
+
+def add_bytes(read=0, written=0):
+    timer = current_timer()
+    if timer is not None:
+        timer.add_bytes(read, written)
+
+
+def set_error(message):
+    # for tasks that catch their own errors instead of raising them
+    timer = current_timer()
+    if timer is not None:
+        timer.error = message
+
+
+def timed_task(task, item_arg=0):
+    # decorator running each call in a TaskTimer, labelled with the
+    # positional argument at item_arg
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TaskTimer(task, str(args[item_arg])):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def setup_telemetry(telemetry_path, mode='w'):
+    '''Sends task records to telemetry_path, one JSON object per line.
+
+    Must be called in the parent before the worker pool is created. The
+    returned handler is passed to report_telemetry at the end of the run.
+    '''
+    os.environ[_RUN_ENV] = '{}-{}'.format(
+        time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    handler = MultiProcessingLog(telemetry_path, mode, 0, 0)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    telemetry_logger.addHandler(handler)
+    telemetry_logger.setLevel(logging.INFO)
+    return handler
+
+
+def load_telemetry(telemetry_path, run=None):
+    records = []
+    with open(telemetry_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if run is None or record.get('run') == run:
+                records.append(record)
+    return records
+
+
+def percentile(values, q):
+    # nearest-rank percentile of a non-empty list
+    values = sorted(values)
+    rank = int(round(q / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+def summarize_telemetry(records, n_slowest=5):
+    lines = []
+    if not records:
+        return lines
+    phase_names = [p for p in PHASES
+                   if any(p in r['phases'] for r in records)]
+    phase_names += sorted(set(p for r in records for p in r['phases'])
+                          - set(PHASES))
+
+    lines.append('{:<12}{:>8}{:>10}{:>10}{:>10}{:>12}'.format(
+        'phase', 'tasks', 'p50 s', 'p95 s', 'max s', 'total s'))
+    for name in phase_names + ['wall']:
+        if name == 'wall':
+            values = [r['wall_s'] for r in records]
+        else:
+            values = [r['phases'][name] for r in records
+                      if name in r['phases']]
+        lines.append('{:<12}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>12.1f}'.format(
+            name, len(values), percentile(values, 50),
+            percentile(values, 95), max(values), sum(values)))
+
+    wall = sum(r['wall_s'] for r in records)
+    n_bytes_read = sum(r['bytes_read'] for r in records)
+    n_bytes_written = sum(r['bytes_written'] for r in records)
+    lines.append('{} tasks in {} workers, {:.1f} MiB read, {:.1f} MiB written,'
+                 ' {} failed'.format(
+                     len(records), len(set(r['pid'] for r in records)),
+                     n_bytes_read / 2.0 ** 20, n_bytes_written / 2.0 ** 20,
+                     sum(1 for r in records if r['error'] is not None)))
+    if wall > 0:
+        lines.append('{:.1f} MiB/s read per busy worker'.format(
+            n_bytes_read / 2.0 ** 20 / wall))
+
+    lines.append('slowest tasks:')
+    for r in sorted(records, key=lambda r: -r['wall_s'])[:n_slowest]:
+        lines.append('  {:.3f} s  pid {}  {}'.format(
+            r['wall_s'], r['pid'], r['item']))
+    return lines
+
+
+def report_telemetry(handler, telemetry_path, out=sys.stderr):
+    # flush the records of this run and print p50/p95/max per phase
+    handler.close()
+    telemetry_logger.removeHandler(handler)
+    records = load_telemetry(telemetry_path, os.environ.get(_RUN_ENV))
+    lines = summarize_telemetry(records)
+    for line in lines:
+        out.write(line + '\n')
+    return records
@@ -0,0 +1,23 @@
+import numpy as np
+import tifffile
+
+
+def imread_memmap(image_path, series=0):
+    '''Reads a TIFF or MetaMorph STK file, memory-mapping it if possible.
+
+    Yokogawa CV7000 TIFFs and STK stacks are usually uncompressed with
+    all pages stored contiguously. In that case the image data is
+    returned as a read-only numpy.memmap backed by the page cache instead
+    of being decoded into fresh heap memory. Compressed or fragmented
+    files fall back to a normal decode.
+    '''
+    with tifffile.TiffFile(image_path) as tif:
+        image_series = tif.series[series]
+        offset = image_series.dataoffset
+        if offset is None:
+            return image_series.asarray()
+        dtype = image_series.dtype.newbyteorder(tif.byteorder)
+        shape = image_series.shape
+
+    return np.memmap(image_path, dtype=dtype, mode='r',
+                     offset=offset, shape=shape)
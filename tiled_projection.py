@@ -0,0 +1,173 @@
+import os
+import logging
+import numpy as np
+import tifffile
+from zprojection import ZProjector, check_statistics, FOCUS_STATISTICS
+
+logger = logging.getLogger(__name__)
+
+# approximate working memory per pixel of a tile for each statistic,
+# including the temporaries created while updating the accumulator
+_STATISTIC_BYTES = {
+    'max': 2, 'min': 2, 'argmax_z': 3, 'mean': 16, 'std': 32
+}
+
+
+class _ArrayRegions(object):
+    # regions of a plane that is already addressable, e.g. a memmap
+    def __init__(self, plane):
+        self.plane = plane
+        self.shape = plane.shape
+        self.dtype = plane.dtype
+        self.chunk_rows = 1
+
+    def read(self, y0, y1, x0, x1):
+        return self.plane[y0:y1, x0:x1]
+
+
+class _SegmentRegions(object):
+    # regions of a compressed page, decoding only the strips or tiles
+    # that overlap the requested region
+    def __init__(self, tif, page):
+        self._fh = tif.filehandle
+        self._page = page
+        self._decode = page.decode
+        self.shape = page.shape
+        self.dtype = page.dtype
+        self.chunk_rows, self._chunk_cols = page.chunks
+        self._n_chunk_cols = page.chunked[1]
+
+    def read(self, y0, y1, x0, x1):
+        region = np.empty((y1 - y0, x1 - x0), dtype=self.dtype)
+        for row in range(y0 // self.chunk_rows,
+                         (y1 - 1) // self.chunk_rows + 1):
+            for col in range(x0 // self._chunk_cols,
+                             (x1 - 1) // self._chunk_cols + 1):
+                index = row * self._n_chunk_cols + col
+                self._fh.seek(self._page.dataoffsets[index])
+                data = self._fh.read(self._page.databytecounts[index])
+                segment, indices, _ = self._decode(data, index)
+                segment = segment.reshape(segment.shape[1:3])
+                top, left = indices[2], indices[3]
+                sy0, sy1 = max(y0, top), min(y1, top + segment.shape[0])
+                sx0, sx1 = max(x0, left), min(x1, left + segment.shape[1])
+                region[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = segment[
+                    sy0 - top:sy1 - top, sx0 - left:sx1 - left]
+        return region
+
+
+def open_plane_regions(image_path, tiff_files):
+    # one region reader per z-plane stored in image_path. Open TiffFile
+    # handles are appended to tiff_files so that the caller can close them
+    tif = tifffile.TiffFile(image_path)
+    tiff_files.append(tif)
+    series = tif.series[0]
+    plane_shape = series.shape[-2:]
+
+    if series.dataoffset is not None:
+        # uncompressed and contiguous: tiles are slices of a memmap
+        planes = np.memmap(
+            image_path, dtype=series.dtype.newbyteorder(tif.byteorder),
+            mode='r', offset=series.dataoffset, shape=series.shape)
+        planes = planes.reshape((-1,) + plane_shape)
+        return [_ArrayRegions(plane) for plane in planes]
+
+    pages = series.pages
+    if all(p is not None and p.shape == plane_shape for p in pages):
+        return [_SegmentRegions(tif, page) for page in pages]
+
+    logger.warning('%s cannot be read by region, decoding it fully',
+                   image_path)
+    planes = series.asarray().reshape((-1,) + plane_shape)
+    return [_ArrayRegions(plane) for plane in planes]
+
+
+def tile_shape(plane_shape, statistics, sum_dtype, plane_dtype,
+               memory_budget, chunk_rows=1):
+    # full-width row bands sized to fit the memory budget, aligned to the
+    # TIFF strip height so that no strip is decoded twice
+    bytes_per_pixel = 2 * np.dtype(plane_dtype).itemsize
+    for statistic in statistics:
+        if statistic == 'sum':
+            bytes_per_pixel += 2 * np.dtype(sum_dtype).itemsize
+        else:
+            bytes_per_pixel += _STATISTIC_BYTES[statistic]
+
+    height, width = plane_shape
+    rows = int(memory_budget // (bytes_per_pixel * width))
+    if rows >= chunk_rows:
+        rows -= rows % chunk_rows
+    if rows >= 1:
+        return min(rows, height), width
+
+    # not even one row fits, split the rows as well
+    return 1, max(1, min(width, int(memory_budget // bytes_per_pixel)))
+
+
+def project_tiled(image_paths, output_paths, statistics=('max', 'sum'),
+                  sum_dtype=np.uint16, memory_budget=64 * 2 ** 20):
+    '''Projects a stack tile by tile within a fixed memory budget.
+
+    The stack is read and reduced in (Y, X) tiles, using memmap slices
+    for uncompressed planes and strip or tile level decoding otherwise.
+    Each finished tile is written straight into memory-mapped output
+    TIFFs, so no full-resolution accumulator is ever allocated. Apart
+    from the focus statistics, which are not supported here, all
+    statistics are element-wise, so the result is identical to projecting
+    whole planes. output_paths is a list of (statistic, path) pairs.
+    '''
+    check_statistics(statistics)
+    focus_statistics = [s for s in statistics if s in FOCUS_STATISTICS]
+    if focus_statistics:
+        # focus metrics depend on the neighbourhood of each pixel and on
+        # whole-plane scores, so they cannot be computed tile by tile
+        raise ValueError('{} cannot be computed in tiled mode'.format(
+            ', '.join(focus_statistics)))
+    tiff_files = []
+    outputs = {}
+    tmp_paths = {}
+    try:
+        planes = []
+        for image_path in image_paths:
+            planes.extend(open_plane_regions(image_path, tiff_files))
+        if not planes:
+            raise ValueError('cannot project an empty list of planes')
+
+        height, width = planes[0].shape
+        tile_h, tile_w = tile_shape(
+            (height, width), statistics, sum_dtype, planes[0].dtype,
+            memory_budget, max(p.chunk_rows for p in planes))
+        logger.debug('projecting %d planes of %dx%d in %dx%d tiles',
+                     len(planes), height, width, tile_h, tile_w)
+
+        for y0 in range(0, height, tile_h):
+            y1 = min(height, y0 + tile_h)
+            for x0 in range(0, width, tile_w):
+                x1 = min(width, x0 + tile_w)
+                projector = ZProjector(statistics, sum_dtype)
+                for plane in planes:
+                    projector.update(plane.read(y0, y1, x0, x1))
+                projections = projector.result()
+
+                for statistic, out_path in output_paths:
+                    if statistic not in outputs:
+                        out_dir, out_name = os.path.split(out_path)
+                        tmp_paths[statistic] = os.path.join(
+                            out_dir, '.tmp-{}-{}'.format(os.getpid(), out_name))
+                        outputs[statistic] = tifffile.memmap(
+                            tmp_paths[statistic], shape=(height, width),
+                            dtype=projections[statistic].dtype)
+                    outputs[statistic][y0:y1, x0:x1] = projections[statistic]
+
+        # flush and rename into place, as zprojection.save_plane does
+        for statistic, out_path in output_paths:
+            outputs[statistic].flush()
+            del outputs[statistic]
+            os.rename(tmp_paths.pop(statistic), out_path)
+    finally:
+        outputs.clear()
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        for tif in tiff_files:
+            tif.close()
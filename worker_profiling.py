@@ -0,0 +1,139 @@
+import os
+import glob
+import json
+import pstats
+import cProfile
+import logging
+import tracemalloc
+from multiprocessing import util
+import task_telemetry
+
+logger = logging.getLogger(__name__)
+
+# exit priority of the finalizer that dumps the worker stats; positive
+# priorities run while the worker is shutting down normally
+_DUMP_PRIORITY = 10
+
+# traced memory of this worker at its largest snapshot, and the snapshot
+_high_water = {'current': 0, 'snapshot': None}
+
+
+def _start_profiling(profile_dir, trace_memory, n_frames):
+    # pool initializer: profile everything this worker runs until it exits
+    profiler = cProfile.Profile()
+    if trace_memory:
+        tracemalloc.start(n_frames)
+        task_telemetry.phase_end_hooks.append(_snapshot_high_water)
+    util.Finalize(None, _dump_profile, args=(profiler, profile_dir),
+                  exitpriority=_DUMP_PRIORITY)
+    profiler.enable()
+
+
+def _snapshot_high_water():
+    # at the end of a task phase, the task's image buffers are still
+    # alive; keep a snapshot whenever more memory is traced than at the
+    # last one, so the report shows the allocations of the largest task
+    current, peak = tracemalloc.get_traced_memory()
+    if current > _high_water['current']:
+        _high_water['current'] = current
+        _high_water['snapshot'] = tracemalloc.take_snapshot()
+
+
+def _dump_profile(profiler, profile_dir):
+    profiler.disable()
+    stem = os.path.join(profile_dir, 'worker-{}'.format(os.getpid()))
+    # snapshot first, so that the profiler's own stats are not included
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        # tasks without telemetry phases fall back to a snapshot at exit
+        snapshot = _high_water['snapshot']
+        snapshot_size = _high_water['current']
+        if snapshot is None:
+            snapshot = tracemalloc.take_snapshot()
+            snapshot_size = current
+        tracemalloc.stop()
+        snapshot.dump(stem + '.tracemalloc')
+        with open(stem + '.json', 'w') as f:
+            json.dump({'pid': os.getpid(), 'current': current,
+                       'peak': peak, 'snapshot': snapshot_size}, f)
+    profiler.dump_stats(stem + '.prof')
+
+
+def profiling_pool_args(profile_dir, trace_memory=False, n_frames=1):
+    '''Keyword arguments for mp.Pool that profile every worker.
+
+    Each worker runs under cProfile, and optionally tracemalloc, and
+    dumps its stats into profile_dir when it exits, i.e. after
+    pool.close() and pool.join(). Workers stopped with pool.terminate()
+    do not write their stats. Returns no arguments when profile_dir is
+    None, so that callers can pass the result unconditionally.
+    '''
+    if profile_dir is None:
+        return {}
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    return {
+        'initializer': _start_profiling,
+        'initargs': (profile_dir, trace_memory, n_frames)
+    }
+
+
+def merge_profiles(profile_dir, pstats_path):
+    # combine the cProfile stats of all workers into one pstats file,
+    # e.g. for snakeviz or python -m pstats
+    profile_paths = sorted(glob.glob(os.path.join(profile_dir, '*.prof')))
+    if not profile_paths:
+        logger.warning('no worker profiles found in %s', profile_dir)
+        return None
+    stats = pstats.Stats(*profile_paths)
+    stats.dump_stats(pstats_path)
+    logger.info('merged %d worker profiles into %s',
+                len(profile_paths), pstats_path)
+    return stats
+
+
+def merge_allocations(profile_dir, report_path, top_n=25):
+    # sum the allocations of each worker's snapshot, taken at the end of
+    # the task phase with the most traced memory, by source line and
+    # write the top_n lines, together with the peak traced memory of
+    # every worker
+    snapshot_paths = sorted(
+        glob.glob(os.path.join(profile_dir, '*.tracemalloc')))
+    if not snapshot_paths:
+        return None
+
+    exclude = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+               tracemalloc.Filter(False, '<unknown>')]
+    sizes = {}
+    counts = {}
+    for snapshot_path in snapshot_paths:
+        snapshot = tracemalloc.Snapshot.load(snapshot_path)
+        for stat in snapshot.filter_traces(exclude).statistics('lineno'):
+            frame = stat.traceback[0]
+            where = '{}:{}'.format(frame.filename, frame.lineno)
+            sizes[where] = sizes.get(where, 0) + stat.size
+            counts[where] = counts.get(where, 0) + stat.count
+
+    workers = []
+    for summary_path in sorted(glob.glob(os.path.join(profile_dir, '*.json'))):
+        with open(summary_path) as f:
+            workers.append(json.load(f))
+
+    with open(report_path, 'w') as f:
+        f.write('peak traced memory per worker\n')
+        for worker in sorted(workers, key=lambda w: -w['peak']):
+            f.write('  pid {:<8} peak {:10.1f} MiB  snapshot {:10.1f} MiB'
+                    '  at exit {:10.1f} MiB\n'.format(
+                        worker['pid'], worker['peak'] / 2.0 ** 20,
+                        worker.get('snapshot', worker['current']) / 2.0 ** 20,
+                        worker['current'] / 2.0 ** 20))
+        f.write('\ntop {} allocation sites at the largest snapshot of each'
+                ' worker, summed over {} workers\n'.format(
+                    top_n, len(snapshot_paths)))
+        for where in sorted(sizes, key=lambda w: -sizes[w])[:top_n]:
+            f.write('  {:10.1f} KiB {:>9} blocks  {}\n'.format(
+                sizes[where] / 1024.0, counts[where], where))
+    logger.info('wrote allocation report of %d workers to %s',
+                len(snapshot_paths), report_path)
+    return report_path
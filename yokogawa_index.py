@@ -0,0 +1,121 @@
+import os
+import re
+from collections import namedtuple
+
+# CV7000 image names, e.g. stem_B03_T0001F001L01A01Z01C01.tif
+pattern = re.compile(
+    r'(?P<stem>.+)_(?P<well>[A-Z]\d{2})_T(?P<t>\d+)F(?P<site>\d+)'
+    r'L(?P<l>\d+)A(?P<a>\d+)Z(?P<z>\d+)(?P<c>C\d{2})\.(?P<ext>[^.]+)$')
+
+
+class YokogawaFile(namedtuple('YokogawaFile',
+                              'stem well t site l a z c ext')):
+    '''Fields of a CV7000 file name, as the strings found in the name.
+
+    Zero padding is kept, so filename rebuilds the original name and
+    _replace() gives renamed copies, e.g. rec._replace(site='002').
+    '''
+    __slots__ = ()
+
+    @property
+    def filename(self):
+        return '{}_{}_T{}F{}L{}A{}Z{}{}.{}'.format(
+            self.stem, self.well, self.t, self.site, self.l, self.a, self.z,
+            self.c, self.ext)
+
+    @property
+    def site_key(self):
+        return self.well, int(self.site)
+
+
+def parse_filename(fname):
+    # YokogawaFile of fname, or None if it is not a CV7000 name
+    m = pattern.match(fname)
+    if m is None:
+        return None
+    return YokogawaFile(*m.groups())
+
+
+class YokogawaIndex(object):
+    '''All CV7000 images of one directory, listed and parsed once.
+
+    Files are grouped by (well, site) and can be looked up by well, site,
+    channel, z-plane and timepoint without rescanning the directory.
+    Sites are ints, channels strings like 'C01', z-planes and timepoints
+    ints. extension restricts the index to e.g. 'tif' or 'png' files.
+    names skips the listing and indexes the given file names instead,
+    e.g. from a PlateIndexDB.
+    '''
+
+    def __init__(self, source_dir, extension=None, names=None):
+        self.source_dir = source_dir
+        self.records = {}
+        self._sites = {}
+        self._planes = {}
+        if names is None:
+            with os.scandir(source_dir) as entries:
+                names = [entry.name for entry in entries]
+        for name in names:
+            if name.startswith('.'):
+                continue
+            rec = parse_filename(name)
+            if rec is None or (extension is not None and
+                               rec.ext != extension):
+                continue
+            self.records[name] = rec
+            site_key = rec.site_key
+            self._sites.setdefault(site_key, []).append(name)
+            self._planes[site_key + (rec.c, int(rec.z), int(rec.t))] = name
+        for site_names in self._sites.values():
+            site_names.sort()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, fname):
+        return fname in self.records
+
+    def wells(self):
+        return sorted(set(well for well, site in self._sites))
+
+    def sites(self, well=None):
+        # sorted site numbers of well, or (well, site) of the whole plate
+        if well is None:
+            return sorted(self._sites)
+        return sorted(site for w, site in self._sites if w == well)
+
+    def channels(self):
+        return sorted(set(rec.c for rec in self.records.values()))
+
+    def z_planes(self):
+        return sorted(set(int(rec.z) for rec in self.records.values()))
+
+    def timepoints(self):
+        return sorted(set(int(rec.t) for rec in self.records.values()))
+
+    def site_files(self, well, site):
+        # sorted names of all files of one site
+        return list(self._sites.get((well, int(site)), []))
+
+    def files_same_site(self, fname):
+        # names of all files of the site of fname, with the same stem
+        rec = self.records.get(fname) or parse_filename(fname)
+        return [f for f in self._sites.get(rec.site_key, [])
+                if self.records[f].stem == rec.stem]
+
+    def get(self, well, site, channel, z=1, t=1):
+        # name of a single plane, or None if it is missing
+        return self._planes.get((well, int(site), channel, int(z), int(t)))
+
+    def select(self, channel=None, z=None, t=None, well=None):
+        # sorted names of the files that match all given fields
+        if well is None:
+            names = self.records
+        else:
+            names = [f for site in self.sites(well)
+                     for f in self._sites[(well, site)]]
+        return sorted(
+            f for f in names for rec in [self.records[f]]
+            if (channel is None or rec.c == channel) and
+            (z is None or int(rec.z) == int(z)) and
+            (t is None or int(rec.t) == int(t)))
@@ -0,0 +1,260 @@
+import os
+import csv
+import numpy as np
+import skimage.io
+from scipy import ndimage
+from tiff_memmap import imread_memmap
+
+# statistics that can be computed in a single pass over the z-planes.
+# argmax_z is the 1-based index of the brightest plane, matching the
+# Z01, Z02, ... numbering in Yokogawa file names. best_focus is the
+# sharpest plane and edf an extended-depth-of-field composite that takes
+# every pixel from the plane that is locally sharpest
+STATISTICS = ('max', 'sum', 'mean', 'min', 'std', 'argmax_z',
+              'best_focus', 'edf')
+FOCUS_STATISTICS = ('best_focus', 'edf')
+FOCUS_METRICS = ('laplacian', 'tenengrad')
+
+
+def read_plane(image_path, memmap=True):
+    # uncompressed planes are memory-mapped so that projections run on
+    # page-cache-backed memory; memmap=False forces the data to be read
+    # immediately, e.g. when prefetching in a background thread
+    plane = imread_memmap(image_path)
+    if not memmap:
+        plane = np.array(plane)
+    return plane
+
+
+def save_plane(image_path, plane):
+    # write to a temporary file next to the target and rename it into
+    # place, so that an interrupted run never leaves a truncated output.
+    # The temporary name keeps the extension for format detection
+    out_dir, out_name = os.path.split(image_path)
+    tmp_path = os.path.join(
+        out_dir, '.tmp-{}-{}'.format(os.getpid(), out_name))
+    try:
+        skimage.io.imsave(fname=tmp_path, arr=plane)
+        os.rename(tmp_path, image_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_focus_scores(scores_path, focus_scores):
+    # per-plane focus scores as a CSV sidecar, written like save_plane
+    tmp_path = scores_path + '.tmp-{}'.format(os.getpid())
+    with open(tmp_path, 'w') as f:
+        wr = csv.writer(f)
+        wr.writerow(['z', 'focus_score'])
+        for z, score in enumerate(focus_scores, 1):
+            wr.writerow([z, repr(float(score))])
+    os.rename(tmp_path, scores_path)
+
+
+def save_output(out_path, name, value):
+    # name is a projection statistic or 'focus_scores'
+    if name == 'focus_scores':
+        save_focus_scores(out_path, value)
+    else:
+        save_plane(out_path, value)
+
+
+def iter_planes(image_paths):
+    # yield one z-plane at a time so that the full (Z, Y, X) stack
+    # never has to be held in memory
+    for image_path in image_paths:
+        yield read_plane(image_path)
+
+
+def check_statistics(statistics):
+    unknown = [s for s in statistics if s not in STATISTICS]
+    if unknown:
+        raise ValueError(
+            'unknown projection statistic(s) {}, choose from {}'.format(
+                ', '.join(unknown), ', '.join(STATISTICS))
+        )
+
+
+class ZProjector(object):
+    '''Computes a set of projections in one pass over the z-planes.
+
+    Accumulators are only allocated for the statistics that are requested
+    and are updated in place as each plane is added. mean and std are
+    accumulated in float64 (Welford's algorithm for std) and returned as
+    float32; std is the population standard deviation, as np.std.
+
+    For best_focus and edf every plane is scored with `focus_metric`,
+    either the variance of the Laplacian or the Tenengrad (mean squared
+    Sobel gradient). edf compares the same response averaged over an
+    `edf_window` neighbourhood pixel by pixel. The per-plane scores are
+    returned as 'focus_scores' alongside the projections.
+    '''
+
+    def __init__(self, statistics=('max', 'sum'), sum_dtype=np.uint16,
+                 focus_metric='laplacian', edf_window=15):
+        check_statistics(statistics)
+        if focus_metric not in FOCUS_METRICS:
+            raise ValueError('unknown focus metric {}, choose from {}'.format(
+                focus_metric, ', '.join(FOCUS_METRICS)))
+        self.statistics = tuple(statistics)
+        self.sum_dtype = sum_dtype
+        self.focus_metric = focus_metric
+        self.edf_window = edf_window
+        self.n_planes = 0
+        self.focus_scores = []
+        self._max = None
+        self._min = None
+        self._sum = None
+        self._argmax = None
+        self._mean = None
+        self._m2 = None
+        self._best = None
+        self._best_score = None
+        self._edf = None
+        self._edf_sharpness = None
+
+    def _needs(self, *names):
+        return any(name in self.statistics for name in names)
+
+    def _focus_response(self, plane):
+        # global focus score and per-pixel focus response of a plane
+        image = np.asarray(plane, dtype=np.float32)
+        if self.focus_metric == 'laplacian':
+            response = ndimage.laplace(image)
+            score = float(response.var())
+            response *= response
+        else:
+            response = ndimage.sobel(image, axis=0)
+            response *= response
+            gradient = ndimage.sobel(image, axis=1)
+            gradient *= gradient
+            response += gradient
+            score = float(response.mean())
+        return score, response
+
+    def _initialise(self, plane, score, response):
+        if self._needs('max', 'argmax_z'):
+            self._max = np.array(plane, copy=True)
+        if self._needs('argmax_z'):
+            self._argmax = np.ones(plane.shape, dtype=np.uint16)
+        if self._needs('min'):
+            self._min = np.array(plane, copy=True)
+        if self._needs('sum'):
+            self._sum = np.array(plane, dtype=self.sum_dtype, copy=True)
+        if self._needs('mean', 'std'):
+            self._mean = np.array(plane, dtype=np.float64, copy=True)
+        if self._needs('std'):
+            self._m2 = np.zeros(plane.shape, dtype=np.float64)
+        if self._needs('best_focus'):
+            self._best = np.array(plane, copy=True)
+            self._best_score = score
+        if self._needs('edf'):
+            self._edf = np.array(plane, copy=True)
+            self._edf_sharpness = ndimage.uniform_filter(
+                response, self.edf_window)
+
+    def update(self, plane):
+        self.n_planes += 1
+        score = response = None
+        if self._needs(*FOCUS_STATISTICS):
+            score, response = self._focus_response(plane)
+            self.focus_scores.append(score)
+
+        if self.n_planes == 1:
+            self._initialise(plane, score, response)
+            return
+
+        if self._argmax is not None:
+            # strictly greater, so ties keep the first plane like np.argmax
+            brighter = plane > self._max
+            self._argmax[brighter] = self.n_planes
+        if self._max is not None:
+            np.maximum(self._max, plane, out=self._max)
+        if self._min is not None:
+            np.minimum(self._min, plane, out=self._min)
+        if self._sum is not None:
+            np.add(self._sum, plane, out=self._sum, casting='unsafe')
+        if self._mean is not None:
+            delta = np.subtract(plane, self._mean, dtype=np.float64)
+            self._mean += delta / self.n_planes
+            if self._m2 is not None:
+                # M2 += delta * (plane - updated mean)
+                delta *= np.subtract(plane, self._mean, dtype=np.float64)
+                self._m2 += delta
+        if self._best is not None and score > self._best_score:
+            np.copyto(self._best, plane)
+            self._best_score = score
+        if self._edf is not None:
+            sharpness = ndimage.uniform_filter(response, self.edf_window)
+            sharper = sharpness > self._edf_sharpness
+            self._edf[sharper] = plane[sharper]
+            np.maximum(self._edf_sharpness, sharpness,
+                       out=self._edf_sharpness)
+
+    def result(self):
+        if self.n_planes == 0:
+            raise ValueError('cannot project an empty list of planes')
+
+        projections = {}
+        for statistic in self.statistics:
+            if statistic == 'max':
+                projections[statistic] = self._max
+            elif statistic == 'min':
+                projections[statistic] = self._min
+            elif statistic == 'sum':
+                projections[statistic] = self._sum
+            elif statistic == 'argmax_z':
+                projections[statistic] = self._argmax
+            elif statistic == 'mean':
+                projections[statistic] = self._mean.astype(np.float32)
+            elif statistic == 'std':
+                projections[statistic] = np.sqrt(
+                    self._m2 / self.n_planes).astype(np.float32)
+            elif statistic == 'best_focus':
+                projections[statistic] = self._best
+            elif statistic == 'edf':
+                projections[statistic] = self._edf
+        if self.focus_scores:
+            projections['focus_scores'] = np.array(self.focus_scores)
+        return projections
+
+
+def project_planes(planes, statistics=('max', 'sum'), sum_dtype=np.uint16,
+                   focus_metric='laplacian', edf_window=15):
+    # reduce an iterable of planes, reading each plane only once
+    projector = ZProjector(statistics, sum_dtype, focus_metric, edf_window)
+    for plane in planes:
+        projector.update(plane)
+    return projector.result()
+
+
+def project_stack(stack, statistics=('max', 'sum'), sum_dtype=np.uint16,
+                  focus_metric='laplacian', edf_window=15):
+    # same outputs as project_planes for a stack already held in memory
+    check_statistics(statistics)
+    if any(s in FOCUS_STATISTICS for s in statistics):
+        # focus scores are computed plane by plane in any case
+        return project_planes(stack, statistics, sum_dtype, focus_metric,
+                              edf_window)
+
+    projections = {}
+    for statistic in statistics:
+        if statistic == 'max':
+            projections[statistic] = np.max(stack, axis=0)
+        elif statistic == 'min':
+            projections[statistic] = np.min(stack, axis=0)
+        elif statistic == 'sum':
+            projections[statistic] = np.sum(stack, axis=0, dtype=sum_dtype)
+        elif statistic == 'argmax_z':
+            projections[statistic] = (
+                np.argmax(stack, axis=0) + 1).astype(np.uint16)
+        elif statistic == 'mean':
+            projections[statistic] = np.mean(
+                stack, axis=0, dtype=np.float64).astype(np.float32)
+        elif statistic == 'std':
+            projections[statistic] = np.std(
+                stack, axis=0, dtype=np.float64).astype(np.float32)
+    return projections
+